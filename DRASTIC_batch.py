@@ -0,0 +1,211 @@
+"""
+***************************************************************************
+*                                                                         *
+*   This program is free software; you can redistribute it and/or modify  *
+*   it under the terms of the GNU General Public License as published by  *
+*   the Free Software Foundation; either version 3 of the License, or     *
+*   (at your option) any later version.                                   *
+*                                                                         *
+***************************************************************************
+
+Headless batch runner for the DRASTIC algorithm.
+
+Runs the jobs of a JSON manifest on a pool of processes, each with its own
+QGIS/GDAL runtime, and writes a report with the timing and outcome of every
+job. A failing job is reported and the batch goes on.
+
+The manifest holds the parameters shared by every job under "defaults" and
+one entry per job under "jobs"; both use the parameter names of the
+Processing algorithm (caminho_points, extensao, pasta, drastic, ...):
+
+    {
+        "defaults": {
+            "caminho_geologia": "data/geologia.shp",
+            "coluna_recla": "CLASSE",
+            "caminho_recla_csv": "data/reclass_geology.csv",
+            ...
+        },
+        "jobs": [
+            {"name": "Braga", "extensao": "-40000,-20000,200000,230000 [EPSG:3763]",
+             "pasta": "out/braga", "drastic": "out/braga/drastic.tif"},
+            ...
+        ]
+    }
+
+Usage:
+    python DRASTIC_batch.py manifest.json [--workers N] [--report report.json]
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import sys
+import time
+import traceback
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+
+VECTOR_INPUTS = ('caminho_points', 'caminho_geologia', 'caminho_soil')
+RASTER_INPUTS = ('caminho_prec', 'caminho_topo')
+
+# Per worker process state, set up by _init_worker
+_qgs = None
+_algorithm = None
+_layers = {}
+
+
+def start_qgis(prefix_path=None):
+    """Start a QGIS application without GUI and make the Processing plugin importable.
+
+    DRASTIC_v3_en imports qgis.processing, which needs the plugins folder on
+    sys.path, so scripts call this before importing it.
+    """
+    from qgis.core import QgsApplication
+
+    if prefix_path:
+        QgsApplication.setPrefixPath(prefix_path, True)
+    qgs = QgsApplication([], False)
+    qgs.initQgis()
+    sys.path.append(os.path.join(QgsApplication.pkgDataPath(), 'python', 'plugins'))
+    return qgs
+
+
+def _init_worker(prefix_path, algorithm_path=None):
+    """Start one QGIS application and Processing framework in this process.
+
+    algorithm_path loads the algorithm from another copy of the script,
+    e.g. an older version to compare against, instead of DRASTIC_v3_en.py.
+    """
+    global _qgs, _algorithm
+    from qgis.core import QgsApplication
+
+    _qgs = start_qgis(prefix_path)
+    from processing.core.Processing import Processing
+    from qgis.analysis import QgsNativeAlgorithms
+
+    Processing.initialize()
+    QgsApplication.processingRegistry().addProvider(QgsNativeAlgorithms())
+
+    sys.path.insert(0, SCRIPT_DIR)
+    if algorithm_path:
+        import importlib.util
+
+        spec = importlib.util.spec_from_file_location('drastic_algorithm', algorithm_path)
+        module = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(module)
+        ExampleProcessingAlgorithm = module.ExampleProcessingAlgorithm
+    else:
+        from DRASTIC_v3_en import ExampleProcessingAlgorithm
+
+    _algorithm = ExampleProcessingAlgorithm().create()
+
+
+def _layer(source, kind):
+    """Load an input layer once per worker; every later job reuses it."""
+    from qgis.core import QgsRasterLayer, QgsVectorLayer
+
+    key = (kind, source)
+    if key not in _layers:
+        layer = QgsVectorLayer(source, os.path.basename(source), 'ogr') if kind == 'vector' else QgsRasterLayer(source, os.path.basename(source))
+        if not layer.isValid():
+            raise ValueError(f"Could not load {source}")
+        _layers[key] = layer
+    return _layers[key]
+
+
+def _run_job(name, parameters):
+    """Run one job and describe the outcome; never raises."""
+    from qgis import processing
+    from qgis.core import QgsProcessingContext, QgsProcessingFeedback
+
+    start = time.perf_counter()
+    report = {'name': name, 'pid': os.getpid()}
+    try:
+        parameters = dict(parameters)
+        for key in VECTOR_INPUTS:
+            if isinstance(parameters.get(key), str):
+                parameters[key] = _layer(parameters[key], 'vector')
+        for key in RASTER_INPUTS:
+            if isinstance(parameters.get(key), str):
+                parameters[key] = _layer(parameters[key], 'raster')
+        if parameters.get('pasta'):
+            os.makedirs(parameters['pasta'], exist_ok=True)
+
+        context = QgsProcessingContext()
+        feedback = QgsProcessingFeedback()
+        results = processing.run(_algorithm, parameters, context=context, feedback=feedback)
+        report['status'] = 'ok'
+        report['outputs'] = {key: value for key, value in results.items() if isinstance(value, (str, int, float, list))}
+    except Exception as e:
+        report['status'] = 'failed'
+        report['error'] = str(e)
+        report['traceback'] = traceback.format_exc()
+    report['seconds'] = round(time.perf_counter() - start, 3)
+    return report
+
+
+def load_manifest(path):
+    """(name, parameters) for every job, with the defaults filled in."""
+    with open(path, encoding='utf-8') as manifest_file:
+        manifest = json.load(manifest_file)
+    if isinstance(manifest, list):
+        manifest = {'jobs': manifest}
+    defaults = manifest.get('defaults', {})
+    jobs = []
+    for number, job in enumerate(manifest.get('jobs', []), start=1):
+        parameters = {**defaults, **job}
+        name = str(parameters.pop('name', f'job {number}'))
+        jobs.append((name, parameters))
+    return jobs
+
+
+def run_batch(jobs, workers=None, prefix_path=None, log=print):
+    """Run jobs on a process pool and return their reports in manifest order."""
+    workers = max(1, min(workers or os.cpu_count() or 1, len(jobs) or 1))
+    # Every job would otherwise run one overlay thread per core: share the cores
+    threads = max(1, (os.cpu_count() or 1) // workers)
+    jobs = [(name, parameters if parameters.get('n_threads') else {**parameters, 'n_threads': threads})
+            for name, parameters in jobs]
+    reports = {}
+    # QGIS is not fork safe: every worker starts from a fresh interpreter
+    context = multiprocessing.get_context('spawn')
+    with ProcessPoolExecutor(workers, mp_context=context, initializer=_init_worker, initargs=(prefix_path,)) as pool:
+        futures = {pool.submit(_run_job, name, parameters): number for number, (name, parameters) in enumerate(jobs)}
+        for future in as_completed(futures):
+            number = futures[future]
+            name = jobs[number][0]
+            try:
+                report = future.result()
+            except Exception as e:
+                # The worker itself died (crash, out of memory...)
+                report = {'name': name, 'status': 'failed', 'error': f'worker failed: {e}'}
+            reports[number] = report
+            log(f"{report['status']:>6}  {report.get('seconds', float('nan')):9.1f} s  {name}"
+                + (f"  ({report['error']})" if report['status'] != 'ok' else ''))
+    return [reports[number] for number in range(len(jobs))]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Run the DRASTIC algorithm headless over a manifest of jobs.')
+    parser.add_argument('manifest', help='JSON manifest with "defaults" and "jobs"')
+    parser.add_argument('--workers', type=int, default=None, help='worker processes (default: one per CPU core)')
+    parser.add_argument('--report', default=None, help='where to write the JSON report (default: next to the manifest)')
+    parser.add_argument('--qgis-prefix', default=os.environ.get('QGIS_PREFIX_PATH'), help='QGIS installation prefix')
+    args = parser.parse_args(argv)
+
+    jobs = load_manifest(args.manifest)
+    start = time.perf_counter()
+    reports = run_batch(jobs, args.workers, args.qgis_prefix)
+    elapsed = time.perf_counter() - start
+
+    failed = [report for report in reports if report['status'] != 'ok']
+    report_path = args.report or os.path.splitext(args.manifest)[0] + '_report.json'
+    with open(report_path, 'w', encoding='utf-8') as report_file:
+        json.dump({'seconds': round(elapsed, 3), 'jobs': reports}, report_file, indent=2)
+    print(f"{len(reports) - len(failed)} of {len(reports)} jobs done in {elapsed:.1f} s, report in {report_path}")
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,368 @@
+"""
+***************************************************************************
+*                                                                         *
+*   This program is free software; you can redistribute it and/or modify  *
+*   it under the terms of the GNU General Public License as published by  *
+*   the Free Software Foundation; either version 3 of the License, or     *
+*   (at your option) any later version.                                   *
+*                                                                         *
+***************************************************************************
+
+Benchmark suite for the DRASTIC algorithm on synthetic inputs.
+
+For every case the suite generates, once, well points, geology and soil
+polygons with class codes, rainfall and DEM rasters and the matching IN_/OUT
+CSVs, all in EPSG:3763 and from a fixed seed. It then runs the algorithm
+headless, like DRASTIC_batch.py, and appends the end-to-end time and the
+per-stage times of the run report to a results file, tagged with the git
+revision, so versions can be compared.
+
+The index of every run is compared with a reference raster kept for the
+case, stored only by a run with --update-reference. Build the references
+with the version to compare against, which --algorithm loads from another
+copy of the script (e.g. one taken with git show), then run the suite on the
+new one; a speedup only counts when the outputs match. Versions that write
+no run report are timed end to end only.
+
+Usage:
+    python DRASTIC_benchmark.py --cases small medium [--repeat 3]
+    python DRASTIC_benchmark.py --wells 50000 --polygons 5000 --pixels 4000
+    python DRASTIC_benchmark.py --algorithm old/DRASTIC_v3_en.py --update-reference
+"""
+import argparse
+import csv
+import json
+import os
+import shutil
+import subprocess
+import sys
+import time
+
+import numpy as np
+from osgeo import gdal, ogr, osr
+
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, SCRIPT_DIR)
+
+import DRASTIC_batch
+
+# name: (wells, polygons, pixels per side)
+CASES = {
+    "tiny": (1_000, 100, 1_000),
+    "small": (10_000, 1_000, 2_500),
+    "medium": (100_000, 10_000, 5_000),
+    "large": (1_000_000, 100_000, 20_000),
+}
+PIXEL_SIZE = 25
+CRS = "EPSG:3763"
+# Upper left corner of the synthetic grids, inside the EPSG:3763 area
+ORIGIN = (-100_000.0, 280_000.0)
+GEOLOGY_CLASSES = 12
+SOIL_CLASSES = 8
+# Rows of pixels generated at a time for the rasters
+ROWS_PER_BLOCK = 256
+
+
+def _srs():
+    srs = osr.SpatialReference()
+    srs.SetFromUserInput(CRS)
+    return srs
+
+
+def _surface(x, y, size, seed, scale):
+    """Smooth, repeatable field over the extent, in [0, 1]."""
+    rng = np.random.default_rng(seed)
+    phases = rng.uniform(0, 2 * np.pi, 4)
+    u, v = x / size, y / size
+    value = (np.sin(2 * np.pi * u * scale + phases[0]) * np.cos(2 * np.pi * v * scale + phases[1])
+             + 0.5 * np.sin(6 * np.pi * (u + v) * scale + phases[2])
+             + 0.25 * np.cos(10 * np.pi * (u - v) * scale + phases[3]))
+    return (value + 1.75) / 3.5
+
+
+def write_wells(path, count, size, seed):
+    """Points with a depth to water field, in metres."""
+    rng = np.random.default_rng(seed)
+    x = rng.uniform(0, size, count)
+    y = rng.uniform(0, size, count)
+    depth = 40 * _surface(x, y, size, seed, 1.5) + rng.normal(0, 1, count)
+    depth = np.clip(depth, 0, None)
+
+    dataset = ogr.GetDriverByName("GPKG").CreateDataSource(path)
+    layer = dataset.CreateLayer("wells", _srs(), ogr.wkbPoint)
+    layer.CreateField(ogr.FieldDefn("depth", ogr.OFTReal))
+    definition = layer.GetLayerDefn()
+    layer.StartTransaction()
+    for xi, yi, di in zip(x + ORIGIN[0], ORIGIN[1] - y, depth):
+        feature = ogr.Feature(definition)
+        feature.SetField("depth", float(di))
+        point = ogr.Geometry(ogr.wkbPoint)
+        point.AddPoint_2D(float(xi), float(yi))
+        feature.SetGeometry(point)
+        layer.CreateFeature(feature)
+    layer.CommitTransaction()
+    dataset = None
+
+
+def write_polygons(path, name, count, size, fields, seed):
+    """A grid of about count rectangles with a random class code per field."""
+    rng = np.random.default_rng(seed)
+    side = max(int(round(np.sqrt(count))), 1)
+    cell = size / side
+    dataset = ogr.GetDriverByName("GPKG").CreateDataSource(path)
+    layer = dataset.CreateLayer(name, _srs(), ogr.wkbPolygon)
+    for field in fields:
+        layer.CreateField(ogr.FieldDefn(field, ogr.OFTInteger))
+    definition = layer.GetLayerDefn()
+    codes = {field: rng.integers(1, classes + 1, side * side) for field, classes in fields.items()}
+    layer.StartTransaction()
+    for n in range(side * side):
+        row, col = divmod(n, side)
+        x0, y0 = ORIGIN[0] + col * cell, ORIGIN[1] - row * cell
+        ring = ogr.Geometry(ogr.wkbLinearRing)
+        for x, y in ((x0, y0), (x0 + cell, y0), (x0 + cell, y0 - cell), (x0, y0 - cell), (x0, y0)):
+            ring.AddPoint_2D(x, y)
+        polygon = ogr.Geometry(ogr.wkbPolygon)
+        polygon.AddGeometry(ring)
+        feature = ogr.Feature(definition)
+        for field in fields:
+            feature.SetField(field, int(codes[field][n]))
+        feature.SetGeometry(polygon)
+        layer.CreateFeature(feature)
+    layer.CommitTransaction()
+    dataset = None
+
+
+def write_raster(path, pixels, size, field):
+    """A Float32 GeoTIFF over the grid, field(x, y) generated by row blocks."""
+    dataset = gdal.GetDriverByName("GTiff").Create(
+        path, pixels, pixels, 1, gdal.GDT_Float32,
+        options=["TILED=YES", "COMPRESS=DEFLATE", "PREDICTOR=3", "BIGTIFF=IF_SAFER"],
+    )
+    dataset.SetGeoTransform((ORIGIN[0], PIXEL_SIZE, 0, ORIGIN[1], 0, -PIXEL_SIZE))
+    dataset.SetProjection(_srs().ExportToWkt())
+    band = dataset.GetRasterBand(1)
+    band.SetNoDataValue(-9999)
+    x = (np.arange(pixels) + 0.5) * PIXEL_SIZE
+    for row in range(0, pixels, ROWS_PER_BLOCK):
+        rows = min(ROWS_PER_BLOCK, pixels - row)
+        y = (row + np.arange(rows) + 0.5) * PIXEL_SIZE
+        band.WriteArray(field(*np.meshgrid(x, y)).astype(np.float32), 0, row)
+    dataset = None
+
+
+def write_reclass_csv(path, classes, seed):
+    """IN_;OUT table rating every class code from 1 to 10."""
+    rng = np.random.default_rng(seed)
+    with open(path, "w", newline="", encoding="utf-8") as csvfile:
+        writer = csv.writer(csvfile, delimiter=";")
+        writer.writerow(["IN_", "OUT"])
+        for code, rating in enumerate(rng.integers(1, 11, classes), start=1):
+            writer.writerow([code, int(rating)])
+
+
+def generate_inputs(folder, wells, polygons, pixels, seed=0, log=print):
+    """Write the inputs of a case in folder, unless they are already there.
+
+    Returns the algorithm parameters that point at them.
+    """
+    spec = {"wells": wells, "polygons": polygons, "pixels": pixels, "seed": seed, "pixel_size": PIXEL_SIZE}
+    spec_path = os.path.join(folder, "inputs.json")
+    paths = {
+        "wells": os.path.join(folder, "wells.gpkg"),
+        "geology": os.path.join(folder, "geology.gpkg"),
+        "soil": os.path.join(folder, "soil.gpkg"),
+        "rainfall": os.path.join(folder, "rainfall.tif"),
+        "dem": os.path.join(folder, "dem.tif"),
+        "recla": os.path.join(folder, "reclass_a.csv"),
+        "recls": os.path.join(folder, "reclass_s.csv"),
+        "recli": os.path.join(folder, "reclass_i.csv"),
+    }
+    existing = None
+    if os.path.exists(spec_path):
+        with open(spec_path, encoding="utf-8") as spec_file:
+            existing = json.load(spec_file)
+    if existing != spec:
+        if os.path.isdir(folder):
+            shutil.rmtree(folder)
+        os.makedirs(folder)
+        size = pixels * PIXEL_SIZE
+        start = time.perf_counter()
+        write_wells(paths["wells"], wells, size, seed)
+        write_polygons(paths["geology"], "geology", polygons, size, {"COD": GEOLOGY_CLASSES}, seed + 1)
+        write_polygons(paths["soil"], "soil", polygons, size, {"S_COD": SOIL_CLASSES, "I_COD": SOIL_CLASSES}, seed + 2)
+        # Net recharge in mm and elevation in m with slopes up to about 30 %
+        write_raster(paths["rainfall"], pixels, size, lambda x, y: 300 * _surface(x, y, size, seed + 3, 2))
+        write_raster(paths["dem"], pixels, size, lambda x, y: 0.02 * size * _surface(x, y, size, seed + 4, 3))
+        write_reclass_csv(paths["recla"], GEOLOGY_CLASSES, seed + 5)
+        write_reclass_csv(paths["recls"], SOIL_CLASSES, seed + 6)
+        write_reclass_csv(paths["recli"], SOIL_CLASSES, seed + 7)
+        with open(spec_path, "w", encoding="utf-8") as spec_file:
+            json.dump(spec, spec_file)
+        log(f"Generated inputs in {folder} in {time.perf_counter() - start:.1f} s")
+
+    xmin, ymax = ORIGIN
+    xmax, ymin = xmin + pixels * PIXEL_SIZE, ymax - pixels * PIXEL_SIZE
+    return {
+        "caminho_points": paths["wells"],
+        "coluna_points": "depth",
+        "caminho_geologia": paths["geology"],
+        "coluna_recla": "COD",
+        "caminho_recla_csv": paths["recla"],
+        "caminho_soil": paths["soil"],
+        "coluna_recls": "S_COD",
+        "caminho_recls_csv": paths["recls"],
+        "coluna_recli": "I_COD",
+        "caminho_recli_csv": paths["recli"],
+        "caminho_prec": paths["rainfall"],
+        "caminho_topo": paths["dem"],
+        "extensao": f"{xmin},{xmax},{ymin},{ymax} [{CRS}]",
+        "tamanho_pixel": PIXEL_SIZE,
+        "sistema_coordenadas": CRS,
+    }
+
+
+def compare_rasters(path, reference):
+    """How far the index at path is from the reference, block by block."""
+    a, b = gdal.Open(path), gdal.Open(reference)
+    if (a.RasterXSize, a.RasterYSize) != (b.RasterXSize, b.RasterYSize):
+        return {"equal": False, "reason": "different sizes"}
+    band_a, band_b = a.GetRasterBand(1), b.GetRasterBand(1)
+    nodata_a, nodata_b = band_a.GetNoDataValue(), band_b.GetNoDataValue()
+    different = nodata_mismatch = 0
+    max_difference = 0.0
+    for yoff in range(0, a.RasterYSize, ROWS_PER_BLOCK):
+        rows = min(ROWS_PER_BLOCK, a.RasterYSize - yoff)
+        values_a = band_a.ReadAsArray(0, yoff, a.RasterXSize, rows).astype(np.float64)
+        values_b = band_b.ReadAsArray(0, yoff, b.RasterXSize, rows).astype(np.float64)
+        empty_a = values_a == nodata_a if nodata_a is not None else np.zeros(values_a.shape, bool)
+        empty_b = values_b == nodata_b if nodata_b is not None else np.zeros(values_b.shape, bool)
+        nodata_mismatch += int((empty_a != empty_b).sum())
+        both = ~empty_a & ~empty_b
+        difference = np.abs(values_a[both] - values_b[both])
+        different += int((difference > 1e-4).sum())
+        if difference.size:
+            max_difference = max(max_difference, float(difference.max()))
+    return {
+        "equal": different == 0 and nodata_mismatch == 0,
+        "different_pixels": different,
+        "nodata_mismatch": nodata_mismatch,
+        "max_abs_difference": max_difference,
+    }
+
+
+def git_revision():
+    try:
+        return subprocess.run(
+            ["git", "describe", "--always", "--dirty"],
+            cwd=SCRIPT_DIR, capture_output=True, text=True, check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run_case(name, wells, polygons, pixels, folder, repeat=1, overrides=None, update_reference=False, log=print):
+    """Run a case repeat times; returns the result record of the fastest run."""
+    parameters = generate_inputs(os.path.join(folder, "inputs", name), wells, polygons, pixels, log=log)
+    parameters.update(overrides or {})
+    runs = []
+    for attempt in range(repeat):
+        output = os.path.join(folder, "runs", name)
+        if os.path.isdir(output):
+            shutil.rmtree(output)
+        os.makedirs(output)
+        job = DRASTIC_batch._run_job(name, {**parameters, "pasta": output, "drastic": os.path.join(output, "drastic.tif")})
+        if job["status"] != "ok":
+            log(job.get("traceback", job["error"]))
+            return {"case": name, "status": "failed", "error": job["error"]}
+        job["report"] = {}
+        report_path = os.path.join(output, "run_report.json")
+        if os.path.exists(report_path):
+            with open(report_path, encoding="utf-8") as report_file:
+                job["report"] = json.load(report_file)
+        log(f"{name} run {attempt + 1}/{repeat}: {job['seconds']:.2f} s")
+        runs.append(job)
+
+    best = min(runs, key=lambda job: job["seconds"])
+    result = {
+        "case": name,
+        "status": "ok",
+        "revision": git_revision(),
+        "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "wells": wells,
+        "polygons": polygons,
+        "pixels": pixels,
+        "overrides": overrides or {},
+        "seconds": best["seconds"],
+        "all_seconds": [job["seconds"] for job in runs],
+        "stages": {
+            step["name"]: step.get("wall_s", step.get("busy_s"))
+            for step in best["report"].get("steps", [])
+        },
+        "peak_rss_mb": best["report"].get("peak_rss_mb"),
+    }
+
+    reference = os.path.join(folder, "reference", f"{name}.tif")
+    output_path = os.path.join(folder, "runs", name, "drastic.tif")
+    if update_reference:
+        os.makedirs(os.path.dirname(reference), exist_ok=True)
+        gdal.GetDriverByName("GTiff").CreateCopy(reference, gdal.Open(output_path))
+        result["reference"] = "stored"
+    elif not os.path.exists(reference):
+        # Never compare a version against itself: references are stored on request
+        result["reference"] = "missing"
+    else:
+        result["reference"] = compare_rasters(output_path, reference)
+    return result
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the DRASTIC algorithm on synthetic inputs.")
+    parser.add_argument("--cases", nargs="*", default=["tiny"], choices=sorted(CASES), help="predefined case sizes")
+    parser.add_argument("--wells", type=int, help="custom case: number of wells")
+    parser.add_argument("--polygons", type=int, help="custom case: number of geology and soil polygons")
+    parser.add_argument("--pixels", type=int, help="custom case: pixels per side of the grid")
+    parser.add_argument("--folder", default=os.path.join(SCRIPT_DIR, "benchmark"), help="inputs, outputs and results")
+    parser.add_argument("--repeat", type=int, default=1, help="runs per case, the fastest is kept")
+    parser.add_argument("--engine", choices=("builtin", "qgis"), default="builtin", help="IDW engine")
+    parser.add_argument("--tile", type=int, default=0, help="block size of the index in pixels (0 = default)")
+    parser.add_argument("--threads", type=int, default=0, help="threads (0 = one per CPU core)")
+    parser.add_argument("--update-reference", action="store_true", help="store this run's outputs as the reference")
+    parser.add_argument("--algorithm", default=None, help="run this copy of DRASTIC_v3_en.py instead, e.g. an older version")
+    parser.add_argument("--qgis-prefix", default=os.environ.get("QGIS_PREFIX_PATH"), help="QGIS installation prefix")
+    args = parser.parse_args(argv)
+
+    cases = {name: CASES[name] for name in args.cases}
+    if args.wells or args.polygons or args.pixels:
+        if not (args.wells and args.polygons and args.pixels):
+            parser.error("a custom case needs --wells, --polygons and --pixels")
+        cases[f"custom_{args.wells}_{args.polygons}_{args.pixels}"] = (args.wells, args.polygons, args.pixels)
+    overrides = {
+        "idw_motor": 0 if args.engine == "builtin" else 1,
+        "tamanho_tile": args.tile,
+        "n_threads": args.threads,
+    }
+
+    DRASTIC_batch._init_worker(args.qgis_prefix, args.algorithm)
+    os.makedirs(args.folder, exist_ok=True)
+    results_path = os.path.join(args.folder, "results.jsonl")
+    mismatches = 0
+    for name, (wells, polygons, pixels) in cases.items():
+        result = run_case(name, wells, polygons, pixels, args.folder, args.repeat, overrides, args.update_reference)
+        with open(results_path, "a", encoding="utf-8") as results_file:
+            results_file.write(json.dumps(result) + "\n")
+        if result["status"] != "ok":
+            mismatches += 1
+            continue
+        check = result["reference"]
+        if isinstance(check, dict) and not check["equal"]:
+            mismatches += 1
+        print(f"{name}: {result['seconds']:.2f} s, reference {check if isinstance(check, str) else ('equal' if check['equal'] else check)}")
+        for stage, seconds in sorted(result["stages"].items(), key=lambda item: -(item[1] or 0)):
+            print(f"  {stage}: {seconds or 0:.2f} s")
+    print(f"Results appended to {results_path}")
+    return 1 if mismatches else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
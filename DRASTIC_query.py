@@ -0,0 +1,145 @@
+"""
+***************************************************************************
+*                                                                         *
+*   This program is free software; you can redistribute it and/or modify  *
+*   it under the terms of the GNU General Public License as published by  *
+*   the Free Software Foundation; either version 3 of the License, or     *
+*   (at your option) any later version.                                   *
+*                                                                         *
+***************************************************************************
+
+DRASTIC index and factor ratings at many points, from a finished run.
+
+Reads a factor stack (the pilha_factores output) or the factor rasters of a
+run kept with its intermediates (d.tif, r.tif, ... in the output folder) and
+samples them at every point of a CSV or vector file in one vectorized call
+of query_points. The points are taken to the grid CRS and the result is a
+';' separated CSV with the input columns, the rating of each factor and the
+index.
+
+Usage:
+    python DRASTIC_query.py out/stack sites.gpkg [--out sites_drastic.csv]
+    python DRASTIC_query.py out/stack sites.csv --x X --y Y --crs EPSG:4326
+"""
+import argparse
+import csv
+import os
+import sys
+import time
+
+import numpy as np
+from osgeo import ogr, osr
+
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, SCRIPT_DIR)
+
+from DRASTIC_batch import start_qgis
+
+
+def open_factors(folder):
+    """The factor stack in folder, or else the factor rasters kept there."""
+    from DRASTIC_v3_en import STACK_METADATA, FactorStack, open_factor_rasters
+
+    if os.path.exists(os.path.join(folder, STACK_METADATA)):
+        return FactorStack.open(folder)
+    return open_factor_rasters(folder)
+
+
+def grid_srs(factors):
+    from DRASTIC_v3_en import FactorStack
+
+    srs = osr.SpatialReference()
+    if isinstance(factors, FactorStack):
+        srs.SetFromUserInput(factors.grid.crs)
+    else:
+        srs.ImportFromWkt(next(iter(factors.values())).dataset.GetProjection())
+    srs.SetAxisMappingStrategy(osr.OAMS_TRADITIONAL_GIS_ORDER)
+    return srs
+
+
+def read_csv_points(path, x_field, y_field):
+    """Header, rows and (n, 2) coordinates of a CSV with coordinate columns."""
+    with open(path, newline='', encoding='utf-8-sig') as csvfile:
+        lines = csvfile.read().splitlines()
+    reader = csv.reader(lines, delimiter=';' if lines and ';' in lines[0] else ',')
+    header = next(reader)
+    rows = [row for row in reader if any(cell.strip() for cell in row)]
+    x, y = header.index(x_field), header.index(y_field)
+    xy = np.array([(float(row[x]), float(row[y])) for row in rows], dtype=np.float64).reshape(-1, 2)
+    return header, rows, xy, None
+
+
+def read_vector_points(path, layer_name=None):
+    """Header, rows and (n, 2) coordinates of the points of a vector layer."""
+    dataset = ogr.Open(path)
+    if dataset is None:
+        raise ValueError(f"Could not open {path}")
+    layer = dataset.GetLayerByName(layer_name) if layer_name else dataset.GetLayer(0)
+    definition = layer.GetLayerDefn()
+    header = ['fid'] + [definition.GetFieldDefn(i).GetName() for i in range(definition.GetFieldCount())]
+    rows, xy = [], []
+    for feature in layer:
+        geometry = feature.GetGeometryRef()
+        if geometry is None or geometry.IsEmpty():
+            continue
+        if geometry.GetGeometryCount():
+            geometry = geometry.GetGeometryRef(0)
+        rows.append([feature.GetFID()] + [feature.GetField(i) for i in range(definition.GetFieldCount())])
+        xy.append((geometry.GetX(), geometry.GetY()))
+    srs = layer.GetSpatialRef()
+    return header, rows, np.array(xy, dtype=np.float64).reshape(-1, 2), srs.Clone() if srs else None
+
+
+def to_grid(xy, source_srs, target_srs):
+    """Coordinates taken from source_srs to target_srs, unchanged without a source CRS."""
+    if source_srs is None or source_srs.IsSame(target_srs) or not len(xy):
+        return xy
+    source_srs.SetAxisMappingStrategy(osr.OAMS_TRADITIONAL_GIS_ORDER)
+    transform = osr.CoordinateTransformation(source_srs, target_srs)
+    return np.array(transform.TransformPoints(xy), dtype=np.float64)[:, :2]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='DRASTIC index and factor ratings at many points.')
+    parser.add_argument('factors', help='factor stack folder, or output folder with the factor rasters')
+    parser.add_argument('points', help='CSV with coordinate columns, or any OGR point layer')
+    parser.add_argument('--layer', default=None, help='layer of a multi-layer vector file')
+    parser.add_argument('--x', default='x', help='X column of a CSV (default: x)')
+    parser.add_argument('--y', default='y', help='Y column of a CSV (default: y)')
+    parser.add_argument('--crs', default=None, help='CRS of the CSV coordinates (default: the grid CRS)')
+    parser.add_argument('--out', default=None, help='output CSV (default: <points>_drastic.csv)')
+    parser.add_argument('--qgis-prefix', default=os.environ.get('QGIS_PREFIX_PATH'), help='QGIS installation prefix')
+    args = parser.parse_args(argv)
+
+    # The algorithm module imports qgis.processing, which needs QGIS set up first
+    qgs = start_qgis(args.qgis_prefix)
+    from DRASTIC_v3_en import FACTORS, query_points
+
+    factors = open_factors(args.factors)
+    if args.points.lower().endswith('.csv'):
+        header, rows, xy, srs = read_csv_points(args.points, args.x, args.y)
+        if args.crs:
+            srs = osr.SpatialReference()
+            srs.SetFromUserInput(args.crs)
+    else:
+        header, rows, xy, srs = read_vector_points(args.points, args.layer)
+
+    start = time.perf_counter()
+    results = query_points(factors, to_grid(xy, srs, grid_srs(factors)))
+    elapsed = time.perf_counter() - start
+
+    out_path = args.out or os.path.splitext(args.points)[0] + '_drastic.csv'
+    columns = list(FACTORS) + ['index']
+    with open(out_path, 'w', newline='', encoding='utf-8') as csvfile:
+        writer = csv.writer(csvfile, delimiter=';')
+        writer.writerow(header + columns)
+        for n, row in enumerate(rows):
+            writer.writerow(list(row) + [results[column][n].item() for column in columns])
+    off_grid = int((results['col'] < 0).sum())
+    print(f"{len(rows)} points queried in {elapsed * 1000:.1f} ms ({off_grid} off the grid), results in {out_path}")
+    qgs.exitQgis()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
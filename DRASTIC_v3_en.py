@@ -9,7 +9,20 @@
 ***************************************************************************
 """
 import csv
-import shutil
+import hashlib
+import json
+import math
+import os
+import re
+import threading
+import time
+import uuid
+from collections import deque
+from contextlib import contextmanager
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from functools import partial
+from datetime import datetime
+from itertools import chain
 from typing import Any, Optional
 
 from qgis.core import (
@@ -19,6 +32,8 @@ from qgis.core import (
     QgsProcessingContext,
     QgsProcessingException,
     QgsProcessingFeedback,
+    QgsProcessingUtils,
+    QgsProcessingMultiStepFeedback,
     QgsProcessingParameterFeatureSink,
     QgsProcessingParameterFeatureSource,
     QgsProcessingParameterRasterLayer,
@@ -26,20 +41,2473 @@ from qgis.core import (
     QgsProcessingParameterFile,
     QgsProcessingParameterFolderDestination,
     QgsProcessingParameterExtent,
-    QgsRasterLayer,
+    QgsProcessingParameterCrs,
     QgsProviderRegistry,
     QgsApplication,
-    QgsVectorLayer,
-    QgsField,
-    QgsProject,
     QgsProcessingParameterNumber,
     QgsProcessingParameterField,
+    QgsProcessingParameterBoolean,
+    QgsProcessingParameterDefinition,
+    QgsProcessingParameterEnum,
+    QgsProcessingParameterString,
+    QgsProcessingParameterDateTime,
+    QgsProcessingParameterMultipleLayers,
+    QgsFeatureRequest,
+    QgsCoordinateReferenceSystem,
+    QgsRectangle,
+    QgsCoordinateTransform,
+    QgsFields,
+    QgsField,
+    QgsFeature,
+    NULL,
     
 )
 from qgis import processing
-from qgis.analysis import QgsRasterCalculator, QgsRasterCalculatorEntry
-from PyQt5.QtCore import QVariant
-from osgeo import gdal
+from qgis.PyQt.QtCore import QVariant
+from osgeo import gdal, ogr, osr
+import numpy as np
+
+try:
+    from scipy.spatial import cKDTree
+except ImportError:
+    cKDTree = None
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+try:
+    import psutil
+except ImportError:
+    psutil = None
+
+#------------------------------------------------------Reclassification tables------------------------------------------------------
+
+# Ratings are stored as (breaks, ratings): a value v gets ratings[k] when
+# breaks[k] <= v < breaks[k + 1]. Values outside [breaks[0], breaks[-1]) and
+# nodata get RATING_NODATA. Ratings are whole numbers carried as uint8
+# from the rating functions to the factor rasters on disk.
+RATING_NODATA = 0
+RATING_DTYPE = np.uint8
+# Top of the DRASTIC rating scale, the default bound of the index
+RATING_MAX = 10
+
+D_BREAKS = (0, 1.524, 4.572, 9.144, 15.24, 22.86, 30.48, 99999)
+D_RATINGS = (10, 9, 7, 5, 3, 2, 1)
+
+R_BREAKS = (0, 50.8, 101.6, 177.8, 254, 99999)
+R_RATINGS = (1, 3, 6, 8, 9)
+
+# Slope in percent
+T_BREAKS = (0, 2, 6, 12, 18, 99999)
+T_RATINGS = (10, 9, 5, 3, 1)
+
+# Side of the square windows read from GDAL at a time
+BLOCK_SIZE = 1024
+
+
+def iter_blocks(xsize: int, ysize: int, block_size: int = BLOCK_SIZE):
+    """Yield (xoff, yoff, width, height) windows covering a raster."""
+    for yoff in range(0, ysize, block_size):
+        height = min(block_size, ysize - yoff)
+        for xoff in range(0, xsize, block_size):
+            width = min(block_size, xsize - xoff)
+            yield xoff, yoff, width, height
+
+
+def reclassify_array(
+    values: np.ndarray,
+    breaks: tuple,
+    ratings: tuple,
+    nodata: Optional[float] = None,
+) -> np.ndarray:
+    """Map values to ratings with one np.digitize and a lookup table."""
+    if len(breaks) != len(ratings) + 1:
+        raise ValueError("breaks must have exactly one more entry than ratings")
+    # Index 0 is below breaks[0], index len(breaks) is at or above breaks[-1]
+    lut = np.array((RATING_NODATA,) + tuple(ratings) + (RATING_NODATA,), dtype=RATING_DTYPE)
+    rated = lut[np.digitize(values, breaks)]
+    invalid = ~np.isfinite(values)
+    if nodata is not None:
+        invalid |= values == nodata
+    rated[invalid] = RATING_NODATA
+    return rated
+
+
+def rate_by_breaks(breaks: tuple, ratings: tuple):
+    """Build a rating function for RatingSource from a breakpoint table."""
+    return partial(reclassify_array, breaks=breaks, ratings=ratings)
+
+
+#------------------------------------------------------Overlay------------------------------------------------------
+
+FACTORS = ("D", "R", "A", "S", "T", "I")
+DRASTIC_WEIGHTS = {"D": 5, "R": 4, "A": 3, "S": 2, "T": 1, "I": 5}
+# Constant term added to every pixel of the index (C is not mapped yet)
+DRASTIC_CONSTANT = 1
+INDEX_NODATA = 0
+# Usual vulnerability classes of the DRASTIC index: a value v is in class k
+# when VULNERABILITY_BREAKS[k - 1] <= v < VULNERABILITY_BREAKS[k]
+VULNERABILITY_BREAKS = (80, 120, 160, 200)
+VULNERABILITY_CLASSES = ("very low", "low", "moderate", "high", "very high")
+# Value of the class raster outside the index; classes are numbered from 1
+CLASS_MAP_NODATA = 0
+# Colours of the lowest, middle and highest class (green, yellow, red)
+CLASS_COLOURS = ((26, 150, 65), (255, 255, 191), (215, 25, 28))
+
+
+def vulnerability_classes(breaks) -> list[str]:
+    """Names of the classes the breaks define: the usual ones for four breaks."""
+    if len(breaks) == len(VULNERABILITY_CLASSES) - 1:
+        return list(VULNERABILITY_CLASSES)
+    return [f"class {k}" for k in range(1, len(breaks) + 2)]
+
+
+def parse_class_breaks(text: str) -> list[float]:
+    """Increasing class breaks typed in a parameter (default VULNERABILITY_BREAKS)."""
+    breaks = [float(item) for item in text.replace(",", " ").split()] if text.strip() else list(VULNERABILITY_BREAKS)
+    if any(high <= low for low, high in zip(breaks, breaks[1:])):
+        raise QgsProcessingException(f"Class breaks must be strictly increasing, got {text!r}")
+    if len(breaks) >= 255:
+        raise QgsProcessingException("At most 254 class breaks fit in a uint8 class raster")
+    return breaks
+
+# GDAL types of the arrays written by the overlay
+GDAL_TYPES = {
+    np.dtype(np.uint8): gdal.GDT_Byte,
+    np.dtype(np.uint16): gdal.GDT_UInt16,
+    np.dtype(np.float32): gdal.GDT_Float32,
+}
+
+
+def index_dtype(weights: dict[str, float], constant: float, max_rating: int = RATING_MAX) -> np.dtype:
+    """Smallest type that holds every index value exactly.
+
+    With whole, non-negative weights and constant the index is a whole
+    number no larger than constant + max_rating * sum(weights), so it fits
+    in uint8 or uint16; anything else is float32.
+    """
+    terms = [weights[f] for f in FACTORS] + [constant]
+    if all(float(term).is_integer() and term >= 0 for term in terms):
+        top = constant + max_rating * sum(weights[f] for f in FACTORS)
+        for dtype in (np.uint8, np.uint16):
+            if top <= np.iinfo(dtype).max:
+                return np.dtype(dtype)
+    return np.dtype(np.float32)
+
+
+class TargetGrid:
+    """The grid every factor is computed on: extent, pixel size and CRS.
+
+    The extent is anchored at its upper left corner and grown to a whole
+    number of square pixels, so every factor, the legacy IDW raster included,
+    lines up pixel for pixel.
+    """
+
+    def __init__(self, bounds: tuple, pixel: float, crs: str):
+        xmin, ymin, xmax, ymax = bounds
+        if pixel <= 0:
+            raise QgsProcessingException("The pixel size must be positive")
+        self.pixel = pixel
+        self.crs = crs
+        self.cols = max(math.ceil((xmax - xmin) / pixel - 1e-9), 1)
+        self.rows = max(math.ceil((ymax - ymin) / pixel - 1e-9), 1)
+        self.bounds = (xmin, ymax - self.rows * pixel, xmin + self.cols * pixel, ymax)
+
+    @property
+    def geotransform(self) -> tuple:
+        xmin, _, _, ymax = self.bounds
+        return (xmin, self.pixel, 0, ymax, 0, -self.pixel)
+
+    def key(self) -> tuple:
+        """What identifies the grid in cache keys."""
+        return self.bounds, self.pixel, self.crs
+
+    def extent_string(self) -> str:
+        """The extent as Processing parameters expect it: xmin,xmax,ymin,ymax [crs]."""
+        xmin, ymin, xmax, ymax = self.bounds
+        return f"{xmin},{xmax},{ymin},{ymax} [{self.crs}]"
+
+    def dataset(self):
+        """An empty VRT that only describes the grid."""
+        dataset = gdal.GetDriverByName("VRT").Create("", self.cols, self.rows, 1, gdal.GDT_Float32)
+        dataset.SetGeoTransform(self.geotransform)
+        srs = osr.SpatialReference()
+        srs.SetFromUserInput(self.crs)
+        dataset.SetProjection(srs.ExportToWkt())
+        return dataset
+
+    def open(self, path: str, resample: str = "near", refine: int = 1):
+        """Open a raster through a virtual warp onto the grid.
+
+        Nothing is read up front: each block read only fetches the source
+        window under that block, so huge rasters are read over the grid only.
+        With refine the grid is split into refine x refine cells per pixel.
+        The view is float32 with NaN as nodata, so grid pixels outside the
+        raster are nodata even when the raster itself declares none.
+        """
+        dataset = gdal.Warp(
+            "",
+            path,
+            format="VRT",
+            outputBounds=self.bounds,
+            width=self.cols * refine,
+            height=self.rows * refine,
+            dstSRS=self.crs,
+            resampleAlg=resample,
+            outputType=gdal.GDT_Float32,
+            dstNodata=float("nan"),
+        )
+        if dataset is None:
+            raise QgsProcessingException(f"Could not open raster {path}")
+        return dataset
+
+    def opener(self, path: str, resample: str = "near", refine: int = 1):
+        """Opener for a RatingSource, which opens one view per thread."""
+        return partial(self.open, path, resample=resample, refine=refine)
+
+    def native_refinement(self, path: str, limit: int = 1) -> int:
+        """How many cells per pixel side match the raster's own resolution, up to limit."""
+        dataset = gdal.Warp("", path, format="VRT", dstSRS=self.crs)
+        if dataset is None:
+            raise QgsProcessingException(f"Could not open raster {path}")
+        native = abs(dataset.GetGeoTransform()[1])
+        return max(1, min(limit, round(self.pixel / native))) if native > 0 else 1
+
+
+def create_raster(path: str, like, data_type: int, nodata: float, bands: int = 1, options: tuple = ()):
+    """Create a GeoTIFF on the same grid as the dataset like."""
+    dataset = gdal.GetDriverByName("GTiff").Create(
+        path, like.RasterXSize, like.RasterYSize, bands, data_type, options=list(options)
+    )
+    if dataset is None:
+        raise QgsProcessingException(f"Could not create raster {path}")
+    dataset.SetGeoTransform(like.GetGeoTransform())
+    dataset.SetProjection(like.GetProjection())
+    for band in range(1, bands + 1):
+        dataset.GetRasterBand(band).SetNoDataValue(nodata)
+    return dataset
+
+
+OUTPUT_FORMATS = ("Tiled, compressed GeoTIFF", "Cloud Optimized GeoTIFF (COG)", "Plain GeoTIFF")
+# Overviews are built down to this size in pixels
+OVERVIEW_MIN_SIZE = 256
+
+
+def parse_creation_options(text: str) -> dict[str, str]:
+    """GDAL creation options given as KEY=VALUE items separated by | or spaces."""
+    options = {}
+    for item in text.replace("|", " ").split():
+        key, sep, value = item.partition("=")
+        if not sep or not key:
+            raise QgsProcessingException(f"Invalid creation option {item!r}, expected KEY=VALUE")
+        options[key.upper()] = value
+    return options
+
+
+class RasterFormat:
+    """How a raster handed to the user is written.
+
+    GeoTIFFs are tiled and compressed with a predictor unless plain. A COG
+    is written as such a GeoTIFF in the temporary folder while the pass runs
+    and copied into the destination once complete. Overviews, when asked
+    for, are built as soon as the pass ends and carried into the COG.
+    options override the creation options of the destination driver.
+    """
+
+    def __init__(self, choice: int = 0, options: Optional[dict[str, str]] = None, overviews: bool = True):
+        self.cog = choice == 1
+        self.tiled = choice != 2
+        self.options = options or {}
+        self.overviews = overviews
+        # Temporary GeoTIFF behind each COG being written, by destination
+        self.scratch = {}
+        # Overview resampling of each finished raster, by destination
+        self.resampling = {}
+
+    @staticmethod
+    def _tiled_options(data_type: int) -> dict[str, str]:
+        floating = data_type in (gdal.GDT_Float32, gdal.GDT_Float64)
+        return {
+            "TILED": "YES",
+            "BLOCKXSIZE": "512",
+            "BLOCKYSIZE": "512",
+            "COMPRESS": "DEFLATE",
+            "PREDICTOR": "3" if floating else "2",
+            "BIGTIFF": "IF_SAFER",
+        }
+
+    def create(self, path: str, like, data_type: int, nodata: float, bands: int = 1):
+        if self.cog:
+            self.scratch[path] = QgsProcessingUtils.generateTempFilename(os.path.basename(path))
+            options = self._tiled_options(data_type)
+            path = self.scratch[path]
+        elif self.tiled:
+            options = {**self._tiled_options(data_type), **self.options}
+        else:
+            options = self.options
+        return create_raster(path, like, data_type, nodata, bands, tuple(f"{k}={v}" for k, v in options.items()))
+
+    def finish(self, dataset, path: str, resampling: str = "NEAREST"):
+        """Build the overviews and flush the dataset written to path.
+
+        The caller then releases every reference to the dataset and calls
+        publish(path), which for a COG needs the scratch file closed.
+        """
+        if self.overviews:
+            levels = []
+            size = max(dataset.RasterXSize, dataset.RasterYSize)
+            while size > OVERVIEW_MIN_SIZE:
+                size = math.ceil(size / 2)
+                levels.append(2 ** (len(levels) + 1))
+            if levels:
+                dataset.BuildOverviews(resampling, levels)
+        dataset.FlushCache()
+        self.resampling[path] = resampling
+
+    def publish(self, path: str):
+        """For a COG, copy the closed scratch GeoTIFF into path and delete it."""
+        resampling = self.resampling.pop(path, "NEAREST")
+        if not self.cog:
+            return
+        scratch = self.scratch.pop(path)
+        options = {
+            "COMPRESS": "DEFLATE",
+            "PREDICTOR": "YES",
+            "BIGTIFF": "IF_SAFER",
+            "RESAMPLING": resampling,
+            "OVERVIEWS": "FORCE_USE_EXISTING" if self.overviews else "NONE",
+            **self.options,
+        }
+        source = gdal.Open(scratch)
+        copy = gdal.GetDriverByName("COG").CreateCopy(path, source, options=[f"{k}={v}" for k, v in options.items()])
+        if copy is None:
+            raise QgsProcessingException(f"Could not write the COG {path}")
+        copy = None
+        source = None
+        gdal.GetDriverByName("GTiff").Delete(scratch)
+
+    def discard(self, path: str):
+        """Drop a raster left unfinished, in place of finish and publish.
+
+        A COG is never written and its scratch GeoTIFF is deleted; other
+        formats keep what was written at path. The dataset must be closed.
+        """
+        self.resampling.pop(path, None)
+        scratch = self.scratch.pop(path, None)
+        if scratch is not None:
+            gdal.GetDriverByName("GTiff").Delete(scratch)
+
+
+# Factor rasters are read back block by block, not browsed
+FACTOR_FORMAT = RasterFormat(overviews=False)
+
+
+class MemoryFolder:
+    """A folder in GDAL's in-memory filesystem for intermediates.
+
+    Files are only read back by GDAL in this process, so they never touch
+    the disk; close drops them all, even while datasets are still open.
+    """
+
+    def __init__(self):
+        self.path = f"/vsimem/drastic_{uuid.uuid4().hex}"
+
+    def file(self, name: str) -> str:
+        return f"{self.path}/{name}"
+
+    def close(self):
+        for name in gdal.ReadDirRecursive(self.path) or []:
+            gdal.Unlink(self.file(name))
+
+
+def read_padded(band, xoff: int, yoff: int, width: int, height: int, halo: int) -> np.ndarray:
+    """Read a window grown by halo pixels on every side as float64.
+
+    Pixels of the halo that fall outside the raster, and nodata, are NaN.
+    """
+    values = np.full((height + 2 * halo, width + 2 * halo), np.nan)
+    x0, y0 = max(xoff - halo, 0), max(yoff - halo, 0)
+    x1 = min(xoff + width + halo, band.XSize)
+    y1 = min(yoff + height + halo, band.YSize)
+    data = band.ReadAsArray(x0, y0, x1 - x0, y1 - y0).astype(np.float64)
+    nodata = band.GetNoDataValue()
+    if nodata is not None:
+        data[data == nodata] = np.nan
+    values[y0 - yoff + halo:y1 - yoff + halo, x0 - xoff + halo:x1 - xoff + halo] = data
+    return values
+
+
+def horn_slope(dem: np.ndarray, cell_x: float, cell_y: float) -> np.ndarray:
+    """Slope in percent of the inner part of a DEM window with a 1 pixel halo.
+
+    Uses Horn's 3x3 kernel like native:slope: NaN neighbours are replaced by
+    the centre cell, and a NaN centre gives a NaN slope. Percent, not
+    degrees, is what T_BREAKS are expressed in.
+    """
+    height, width = dem.shape[0] - 2, dem.shape[1] - 2
+    centre = dem[1:-1, 1:-1]
+
+    def cell(dy, dx):
+        neighbour = dem[dy:dy + height, dx:dx + width]
+        return np.where(np.isnan(neighbour), centre, neighbour)
+
+    z1, z2, z3 = cell(0, 0), cell(0, 1), cell(0, 2)
+    z4, z6 = cell(1, 0), cell(1, 2)
+    z7, z8, z9 = cell(2, 0), cell(2, 1), cell(2, 2)
+    dz_dx = ((z3 + 2 * z6 + z9) - (z1 + 2 * z4 + z7)) / (8 * cell_x)
+    dz_dy = ((z7 + 2 * z8 + z9) - (z1 + 2 * z2 + z3)) / (8 * cell_y)
+    return 100 * np.hypot(dz_dx, dz_dy)
+
+
+class RatingSource:
+    """A factor raster aligned to the output grid and rated block by block.
+
+    open_dataset is called once per thread, since GDAL handles cannot be
+    shared between threads. rate maps (values, nodata=...) to ratings;
+    without it the raster is assumed to hold ratings already.
+    """
+
+    halo = 0
+
+    def __init__(self, open_dataset, rate=None):
+        self.open_dataset = open_dataset
+        self.rate = rate
+        self._local = threading.local()
+
+    @property
+    def dataset(self):
+        dataset = getattr(self._local, "dataset", None)
+        if dataset is None:
+            dataset = self._local.dataset = self.open_dataset()
+        return dataset
+
+    def read(self, xoff: int, yoff: int, width: int, height: int) -> np.ndarray:
+        band = self.dataset.GetRasterBand(1)
+        nodata = band.GetNoDataValue()
+        values = band.ReadAsArray(xoff, yoff, width, height)
+        if self.rate is not None:
+            return self.rate(values, nodata=nodata)
+        invalid = ~np.isfinite(values)
+        if nodata is not None:
+            invalid |= values == nodata
+        return np.where(invalid, RATING_NODATA, values).astype(RATING_DTYPE)
+
+
+# Most DEM cells under one output pixel side the slope is computed on, and
+# most DEM cells held at once by one window
+SLOPE_REFINE_MAX = 32
+SLOPE_CHUNK = 1 << 22
+
+
+class SlopeRatingSource(RatingSource):
+    """T factor computed from a DEM window and its 1 pixel halo.
+
+    open_dataset gives the DEM on the output grid refined refine times, i.e.
+    close to the DEM's own resolution (see TargetGrid.native_refinement):
+    the slope is computed on those cells and averaged over the refine x
+    refine cells of each output pixel, so a fine DEM is not flattened by
+    resampling it to the output pixel first. The slope only lives as long
+    as the strip of the block it is rated in, and the DEM is only read
+    under the output grid.
+    """
+
+    halo = 1
+
+    def __init__(self, open_dataset, rate=None, refine: int = 1):
+        super().__init__(open_dataset, rate)
+        self.refine = refine
+
+    def read(self, xoff: int, yoff: int, width: int, height: int) -> np.ndarray:
+        dataset = self.dataset
+        geotransform = dataset.GetGeoTransform()
+        band = dataset.GetRasterBand(1)
+        f = self.refine
+        slope = np.empty((height, width))
+        strip = max(1, SLOPE_CHUNK // (width * f * f))
+        for top in range(0, height, strip):
+            rows = min(strip, height - top)
+            dem = read_padded(band, xoff * f, (yoff + top) * f, width * f, rows * f, self.halo)
+            cells = horn_slope(dem, abs(geotransform[1]), abs(geotransform[5])).reshape(rows, f, width, f)
+            found = np.isfinite(cells)
+            count = found.sum(axis=(1, 3))
+            with np.errstate(invalid="ignore"):
+                slope[top:top + rows] = np.where(found, cells, 0).sum(axis=(1, 3)) / count
+        return self.rate(slope, nodata=None)
+
+
+class OverlayOutput:
+    """Something derived from every window of the overlay pass.
+
+    open() is called once with a dataset describing the grid. compute() runs
+    on the thread that computed the window and must not touch shared state;
+    its result is handed to write() on the calling thread, in window order.
+    close() is always called, with completed false when the pass was
+    cancelled before every window was written; rasters are then discarded
+    rather than finished and published.
+    """
+
+    def open(self, like):
+        pass
+
+    def compute(self, window: tuple, ratings: dict[str, np.ndarray], index: np.ndarray, valid: np.ndarray):
+        return None
+
+    def write(self, window: tuple, result):
+        pass
+
+    def close(self, completed: bool = True):
+        pass
+
+
+def read_weight_scenarios(path: str) -> list[tuple]:
+    """Weight sets from a CSV with D, R, A, S, T and I columns.
+
+    An optional C column gives the constant term (DRASTIC_CONSTANT when
+    missing) and an optional NAME column names the scenario. Returns
+    (name, weights, constant) tuples.
+    """
+    with open(path, newline='', encoding='utf-8-sig') as csvfile:
+        lines = csvfile.read().splitlines()
+    if not lines:
+        raise QgsProcessingException(f"{path}: the scenario CSV is empty")
+    reader = csv.reader(lines, delimiter=';' if ';' in lines[0] else ',')
+    headers = [header.strip().upper() for header in next(reader)]
+    missing = [f for f in FACTORS if f not in headers]
+    if missing:
+        raise QgsProcessingException(f"{path}: the scenario CSV has no column for {', '.join(missing)}")
+
+    scenarios = []
+    for line, row in enumerate(reader, start=2):
+        if not any(cell.strip() for cell in row):
+            continue
+        values = dict(zip(headers, (cell.strip() for cell in row)))
+        try:
+            weights = {f: float(values[f]) for f in FACTORS}
+            constant = float(values['C']) if values.get('C') else DRASTIC_CONSTANT
+        except (KeyError, ValueError):
+            raise QgsProcessingException(f"{path}, line {line}: expected numeric weights, got {row}")
+        scenarios.append((values.get('NAME') or f"scenario {len(scenarios) + 1}", weights, constant))
+    return scenarios
+
+
+class ScenarioOutput(OverlayOutput):
+    """The index under many weight sets, one band per scenario.
+
+    All scenarios come out of a single matrix product with the stack of
+    factor ratings, so they cost one read of the factors. The bands share
+    the smallest type that holds every scenario, see index_dtype.
+    """
+
+    def __init__(
+        self,
+        path: str,
+        scenarios: list[tuple],
+        raster_format: Optional[RasterFormat] = None,
+        max_rating: int = RATING_MAX,
+    ):
+        self.path = path
+        self.raster_format = raster_format or RasterFormat()
+        self.names = [name for name, _, _ in scenarios]
+        self.matrix = np.array([[weights[f] for f in FACTORS] for _, weights, _ in scenarios], dtype=np.float32)
+        self.constants = np.array([constant for _, _, constant in scenarios], dtype=np.float32)
+        dtypes = [index_dtype(weights, constant, max_rating) for _, weights, constant in scenarios]
+        self.dtype = max(dtypes, key=list(GDAL_TYPES).index)
+
+    def open(self, like):
+        self.dataset = self.raster_format.create(
+            self.path, like, GDAL_TYPES[self.dtype], INDEX_NODATA, bands=len(self.names)
+        )
+        for band, name in enumerate(self.names, start=1):
+            self.dataset.GetRasterBand(band).SetDescription(name)
+
+    def compute(self, window, ratings, index, valid):
+        stack = np.stack([ratings[f] for f in FACTORS])
+        result = np.tensordot(self.matrix, stack, axes=1) + self.constants[:, None, None]
+        result[:, ~valid] = INDEX_NODATA
+        return result.astype(self.dtype, copy=False)
+
+    def write(self, window, result):
+        for band in range(len(self.names)):
+            self.dataset.GetRasterBand(band + 1).WriteArray(result[band], window[0], window[1])
+
+    def close(self, completed: bool = True):
+        if completed:
+            self.raster_format.finish(self.dataset, self.path, "AVERAGE")
+        self.dataset = None
+        (self.raster_format.publish if completed else self.raster_format.discard)(self.path)
+
+
+class RunningStats:
+    """Count, mean, variance, min and max of several series, merged by blocks.
+
+    Blocks are combined with Chan et al.'s parallel update, so nothing but
+    the accumulators is ever kept.
+    """
+
+    def __init__(self, series: int):
+        self.count = 0
+        self.mean = np.zeros(series)
+        self.m2 = np.zeros(series)
+        self.min = np.full(series, np.inf)
+        self.max = np.full(series, -np.inf)
+
+    @staticmethod
+    def block(values: np.ndarray) -> tuple:
+        """Partial statistics of values shaped (series, samples)."""
+        if values.shape[1] == 0:
+            return (0, None, None, None, None)
+        mean = values.mean(axis=1)
+        m2 = ((values - mean[:, None]) ** 2).sum(axis=1)
+        return (values.shape[1], mean, m2, values.min(axis=1), values.max(axis=1))
+
+    def merge(self, partial_stats: tuple):
+        count, mean, m2, low, high = partial_stats
+        if not count:
+            return
+        total = self.count + count
+        delta = mean - self.mean
+        self.mean = self.mean + delta * count / total
+        self.m2 = self.m2 + m2 + delta ** 2 * self.count * count / total
+        self.count = total
+        self.min = np.minimum(self.min, low)
+        self.max = np.maximum(self.max, high)
+
+    @property
+    def std(self) -> np.ndarray:
+        return np.sqrt(self.m2 / self.count) if self.count else np.full_like(self.mean, np.nan)
+
+
+# Value written where an effective weight is undefined
+EFFECTIVE_WEIGHT_NODATA = -1
+
+
+class SensitivityOutput(OverlayOutput):
+    """Map removal and single-parameter sensitivity, accumulated per window.
+
+    Map removal (Lodwick et al.) drops one factor at a time and measures the
+    variation index |V/N - V'/n| / V * 100, where N counts the factors of the
+    index including the constant term and n = N - 1. The single-parameter
+    analysis (Napolitano and Fabbri) gives each factor's effective weight
+    W = w * r / V * 100. effective_path optionally receives W per pixel, one
+    band per factor.
+    """
+
+    def __init__(
+        self,
+        weights: dict[str, float],
+        effective_path: Optional[str] = None,
+        raster_format: Optional[RasterFormat] = None,
+    ):
+        self.weights = np.array([weights[f] for f in FACTORS], dtype=np.float64)
+        self.effective_path = effective_path
+        self.raster_format = raster_format or RasterFormat()
+        self.map_removal = RunningStats(len(FACTORS))
+        self.single_parameter = RunningStats(len(FACTORS))
+
+    def open(self, like):
+        self.dataset = None
+        if self.effective_path:
+            self.dataset = self.raster_format.create(
+                self.effective_path, like, gdal.GDT_Float32, EFFECTIVE_WEIGHT_NODATA, bands=len(FACTORS)
+            )
+            for band, factor in enumerate(FACTORS, start=1):
+                self.dataset.GetRasterBand(band).SetDescription(factor)
+
+    def compute(self, window, ratings, index, valid):
+        # Only pixels with a positive index are defined for either analysis
+        use = valid & (index > 0)
+        total = index[use].astype(np.float64)
+        weighted = self.weights[:, None] * np.stack([ratings[f][use] for f in FACTORS]).astype(np.float64)
+        factors = len(FACTORS) + 1
+        variation = np.abs(total / factors - (total - weighted) / (factors - 1)) / total * 100
+        effective = weighted / total * 100
+
+        pixels = None
+        if self.dataset is not None:
+            pixels = np.full((len(FACTORS),) + index.shape, EFFECTIVE_WEIGHT_NODATA, dtype=np.float32)
+            pixels[:, use] = effective
+        return RunningStats.block(variation), RunningStats.block(effective), pixels
+
+    def write(self, window, result):
+        variation, effective, pixels = result
+        self.map_removal.merge(variation)
+        self.single_parameter.merge(effective)
+        if pixels is not None:
+            for band in range(len(FACTORS)):
+                self.dataset.GetRasterBand(band + 1).WriteArray(pixels[band], window[0], window[1])
+
+    def close(self, completed: bool = True):
+        if self.dataset is not None:
+            if completed:
+                self.raster_format.finish(self.dataset, self.effective_path, "AVERAGE")
+            self.dataset = None
+            (self.raster_format.publish if completed else self.raster_format.discard)(self.effective_path)
+
+    def rows(self) -> dict[str, list[list]]:
+        """Summary table rows of both analyses, by analysis name."""
+        theoretical = self.weights / self.weights.sum() * 100 if self.weights.sum() else self.weights
+        tables = {}
+        for name, stats in (("map_removal", self.map_removal), ("single_parameter", self.single_parameter)):
+            header = ["factor", "mean", "min", "max", "std"]
+            body = [
+                [factor, stats.mean[k], stats.min[k], stats.max[k], stats.std[k]]
+                for k, factor in enumerate(FACTORS)
+            ]
+            if name == "single_parameter":
+                header.append("theoretical_weight")
+                for k, row in enumerate(body):
+                    row.append(theoretical[k])
+            tables[name] = [header] + body
+        return tables
+
+    def save(self, folder: str) -> dict[str, str]:
+        """Write both summary tables as ';' separated CSV files in folder."""
+        paths = {}
+        for name, rows in self.rows().items():
+            paths[name] = os.path.join(folder, f"sensitivity_{name}.csv")
+            with open(paths[name], "w", newline="", encoding="utf-8") as csvfile:
+                csv.writer(csvfile, delimiter=";").writerows(rows)
+        return paths
+
+
+def class_colour_table(classes: int):
+    """GDAL colour table from green (class 1) to red (last class)."""
+    table = gdal.ColorTable()
+    table.SetColorEntry(CLASS_MAP_NODATA, (0, 0, 0, 0))
+    for k in range(classes):
+        position = k / (classes - 1) * 2 if classes > 1 else 0
+        low = min(int(position), 1)
+        weight = position - low
+        colour = tuple(
+            round(a + (b - a) * weight) for a, b in zip(CLASS_COLOURS[low], CLASS_COLOURS[low + 1])
+        )
+        table.SetColorEntry(k + 1, colour + (255,))
+    return table
+
+
+class ClassOutput(OverlayOutput):
+    """Vulnerability classes of the index, its exact histogram and class areas.
+
+    Class k holds the index values v with breaks[k - 2] <= v < breaks[k - 1]
+    (class 1 everything below the first break) and is written as uint8 to
+    path when given. The histogram counts every distinct index value: whole
+    indexes with bincount, float indexes with unique, merged every few
+    dozen windows; the class areas follow from it exactly, so neither
+    needs a read of the index afterwards.
+    """
+
+    # Windows whose histograms are kept before merging them
+    MERGE_EVERY = 64
+
+    def __init__(
+        self,
+        breaks=VULNERABILITY_BREAKS,
+        names: Optional[list[str]] = None,
+        path: Optional[str] = None,
+        raster_format: Optional[RasterFormat] = None,
+    ):
+        self.breaks = np.asarray(breaks, dtype=np.float64)
+        self.names = list(names or vulnerability_classes(breaks))
+        if len(self.names) != len(self.breaks) + 1:
+            raise QgsProcessingException(
+                f"{len(self.breaks)} class breaks make {len(self.breaks) + 1} classes, got {len(self.names)} names"
+            )
+        self.path = path
+        self.raster_format = raster_format or RasterFormat()
+        self.values = np.zeros(0)
+        self.counts = np.zeros(0, dtype=np.int64)
+        self.pending = []
+        self.whole = True
+
+    def open(self, like):
+        geotransform = like.GetGeoTransform()
+        self.pixel_area = abs(geotransform[1] * geotransform[5])
+        self.dataset = None
+        if self.path:
+            self.dataset = self.raster_format.create(self.path, like, gdal.GDT_Byte, CLASS_MAP_NODATA)
+            band = self.dataset.GetRasterBand(1)
+            band.SetRasterCategoryNames([""] + self.names)
+            band.SetRasterColorTable(class_colour_table(len(self.names)))
+            band.SetRasterColorInterpretation(gdal.GCI_PaletteIndex)
+
+    def compute(self, window, ratings, index, valid):
+        values = index[valid]
+        if index.dtype.kind == "f":
+            distinct, counts = np.unique(values, return_counts=True)
+        else:
+            counts = np.bincount(values)
+            distinct = np.flatnonzero(counts)
+            counts = counts[distinct]
+        classes = None
+        if self.dataset is not None:
+            classes = np.full(index.shape, CLASS_MAP_NODATA, dtype=np.uint8)
+            classes[valid] = np.digitize(values, self.breaks) + 1
+        return distinct, counts, classes
+
+    def write(self, window, result):
+        distinct, counts, classes = result
+        self.whole = self.whole and distinct.dtype.kind != "f"
+        self.pending.append((distinct, counts))
+        if len(self.pending) >= self.MERGE_EVERY:
+            self._merge()
+        if classes is not None:
+            self.dataset.GetRasterBand(1).WriteArray(classes, window[0], window[1])
+
+    def _merge(self):
+        if not self.pending:
+            return
+        values = np.concatenate([self.values] + [distinct for distinct, _ in self.pending])
+        counts = np.concatenate([self.counts] + [counts for _, counts in self.pending])
+        self.pending = []
+        self.values, inverse = np.unique(values, return_inverse=True)
+        self.counts = np.zeros(len(self.values), dtype=np.int64)
+        np.add.at(self.counts, inverse.reshape(-1), counts)
+
+    def close(self, completed: bool = True):
+        self._merge()
+        if self.dataset is not None:
+            if completed:
+                self.raster_format.finish(self.dataset, self.path, "NEAREST")
+            self.dataset = None
+            (self.raster_format.publish if completed else self.raster_format.discard)(self.path)
+
+    def histogram(self) -> list[list]:
+        """Rows of value, pixels and area, by increasing index value."""
+        self._merge()
+        values = self.values.astype(np.int64) if self.whole else self.values
+        return [["value", "pixels", "area"]] + [
+            [value, int(count), float(count) * self.pixel_area] for value, count in zip(values.tolist(), self.counts)
+        ]
+
+    def class_areas(self) -> list[list]:
+        """Rows of class, name, range, pixels, area and share of the index."""
+        self._merge()
+        pixels = np.bincount(
+            np.digitize(self.values, self.breaks), weights=self.counts, minlength=len(self.names)
+        ).astype(np.int64)
+        total = pixels.sum()
+        limits = [None] + self.breaks.tolist() + [None]
+        rows = [["class", "name", "from", "to", "pixels", "area", "percent"]]
+        for k, name in enumerate(self.names):
+            rows.append([
+                k + 1, name, limits[k], limits[k + 1], int(pixels[k]), float(pixels[k]) * self.pixel_area,
+                pixels[k] / total * 100 if total else 0.0,
+            ])
+        return rows
+
+    def save(self, folder: str) -> dict[str, str]:
+        """Write the histogram and class area tables as ';' separated CSV files in folder."""
+        paths = {}
+        for name, rows in (("histogram", self.histogram()), ("class_areas", self.class_areas())):
+            paths[name] = os.path.join(folder, f"drastic_{name}.csv")
+            with open(paths[name], "w", newline="", encoding="utf-8") as csvfile:
+                csv.writer(csvfile, delimiter=";").writerows(rows)
+        return paths
+
+
+# Type of the change between two epochs, by index type, and its nodata
+CHANGE_TYPES = {
+    np.dtype(np.uint8): (np.dtype(np.int16), gdal.GDT_Int16),
+    np.dtype(np.uint16): (np.dtype(np.int32), gdal.GDT_Int32),
+    np.dtype(np.float32): (np.dtype(np.float32), gdal.GDT_Float32),
+}
+CHANGE_NODATA = -32768
+
+
+class EpochOutput(OverlayOutput):
+    """The index over a series of epochs, one band per epoch.
+
+    Only D and R change from one epoch to the next: the other factors are
+    weighted once per window into a partial index, and each epoch adds its
+    own D and R ratings to it. epochs holds (name, {"D": source, "R":
+    source}) tuples; a None source stands for the overlay's own factor,
+    whose ratings are reused, and a source shared by several epochs is read
+    once per window, so only the layers that really change cost a read.
+    change_path optionally receives the change of the index between
+    consecutive epochs (epoch k + 1 minus epoch k), one band per pair.
+    """
+
+    VARYING = ("D", "R")
+
+    def __init__(
+        self,
+        path: str,
+        epochs: list[tuple],
+        weights: dict[str, float],
+        constant: float,
+        change_path: Optional[str] = None,
+        raster_format: Optional[RasterFormat] = None,
+        max_rating: int = RATING_MAX,
+    ):
+        self.path = path
+        self.names = [name for name, _ in epochs]
+        self.sources = [sources for _, sources in epochs]
+        self.weights = weights
+        self.constant = constant
+        self.change_path = change_path if len(epochs) > 1 else None
+        self.raster_format = raster_format or RasterFormat()
+        self.dtype = index_dtype(weights, constant, max_rating)
+        self.change_dtype, self.change_type = CHANGE_TYPES[self.dtype]
+        self.count = np.zeros(len(epochs), dtype=np.int64)
+        self.sum = np.zeros(len(epochs))
+        self.min = np.full(len(epochs), np.inf)
+        self.max = np.full(len(epochs), -np.inf)
+
+    def open(self, like):
+        self.dataset = self.raster_format.create(
+            self.path, like, GDAL_TYPES[self.dtype], INDEX_NODATA, bands=len(self.names)
+        )
+        for band, name in enumerate(self.names, start=1):
+            self.dataset.GetRasterBand(band).SetDescription(name)
+        self.change = None
+        if self.change_path:
+            self.change = self.raster_format.create(
+                self.change_path, like, self.change_type, CHANGE_NODATA, bands=len(self.names) - 1
+            )
+            for band, (before, after) in enumerate(zip(self.names, self.names[1:]), start=1):
+                self.change.GetRasterBand(band).SetDescription(f"{after} - {before}")
+
+    def compute(self, window, ratings, index, valid):
+        xoff, yoff, width, height = window
+        accumulator = np.float32 if self.dtype.kind == "f" else np.uint16
+        static = np.full((height, width), self.constant, dtype=accumulator)
+        static_valid = np.ones((height, width), dtype=bool)
+        for factor in FACTORS:
+            if factor not in self.VARYING:
+                static_valid &= ratings[factor] != RATING_NODATA
+                static += ratings[factor].astype(accumulator) * accumulator(self.weights[factor])
+
+        epochs = np.empty((len(self.names), height, width), dtype=self.dtype)
+        epochs_valid = np.empty(epochs.shape, dtype=bool)
+        read = {}
+        for epoch, sources in enumerate(self.sources):
+            epoch_index = static.copy()
+            epoch_valid = static_valid.copy()
+            for factor in self.VARYING:
+                source = sources[factor]
+                if source is None:
+                    rating = ratings[factor]
+                else:
+                    if id(source) not in read:
+                        read[id(source)] = source.read(xoff, yoff, width, height)
+                    rating = read[id(source)]
+                epoch_valid &= rating != RATING_NODATA
+                epoch_index += rating.astype(accumulator) * accumulator(self.weights[factor])
+            epoch_index[~epoch_valid] = INDEX_NODATA
+            epochs[epoch] = epoch_index
+            epochs_valid[epoch] = epoch_valid
+
+        statistics = [
+            (len(values), values.sum(dtype=np.float64), values.min(), values.max()) if len(values) else None
+            for values in (epochs[epoch][epochs_valid[epoch]] for epoch in range(len(self.names)))
+        ]
+        change = None
+        if self.change is not None:
+            change = epochs[1:].astype(self.change_dtype) - epochs[:-1].astype(self.change_dtype)
+            change[~(epochs_valid[1:] & epochs_valid[:-1])] = CHANGE_NODATA
+        return epochs, statistics, change
+
+    def write(self, window, result):
+        epochs, statistics, change = result
+        for epoch, partial_stats in enumerate(statistics):
+            self.dataset.GetRasterBand(epoch + 1).WriteArray(epochs[epoch], window[0], window[1])
+            if partial_stats is not None:
+                count, total, low, high = partial_stats
+                self.count[epoch] += count
+                self.sum[epoch] += total
+                self.min[epoch] = min(self.min[epoch], low)
+                self.max[epoch] = max(self.max[epoch], high)
+        if change is not None:
+            for band in range(len(change)):
+                self.change.GetRasterBand(band + 1).WriteArray(change[band], window[0], window[1])
+
+    def close(self, completed: bool = True):
+        conclude = self.raster_format.publish if completed else self.raster_format.discard
+        if completed:
+            self.raster_format.finish(self.dataset, self.path, "AVERAGE")
+        self.dataset = None
+        conclude(self.path)
+        if self.change is not None:
+            if completed:
+                self.raster_format.finish(self.change, self.change_path, "AVERAGE")
+            self.change = None
+            conclude(self.change_path)
+
+    def rows(self) -> list[list]:
+        """Rows of epoch, pixels, mean, min and max of the index."""
+        rows = [["epoch", "pixels", "mean", "min", "max"]]
+        for epoch, name in enumerate(self.names):
+            count = int(self.count[epoch])
+            if count:
+                rows.append([name, count, self.sum[epoch] / count, float(self.min[epoch]), float(self.max[epoch])])
+            else:
+                rows.append([name, 0, None, None, None])
+        return rows
+
+    def save(self, folder: str) -> str:
+        """Write the per epoch summary as a ';' separated CSV file in folder."""
+        path = os.path.join(folder, "drastic_epochs.csv")
+        with open(path, "w", newline="", encoding="utf-8") as csvfile:
+            csv.writer(csvfile, delimiter=";").writerows(self.rows())
+        return path
+
+
+def _overlay_window(
+    sources: dict[str, RatingSource],
+    weights: dict[str, float],
+    constant: float,
+    dtype: np.dtype,
+    outputs: list[OverlayOutput],
+    window: tuple,
+):
+    xoff, yoff, width, height = window
+    # Whole indexes are summed in uint16, which index_dtype guarantees is enough
+    accumulator = np.float32 if dtype.kind == "f" else np.uint16
+    index = np.full((height, width), constant, dtype=accumulator)
+    valid = np.ones((height, width), dtype=bool)
+    ratings = {}
+    # Time spent reading and rating each factor, where IDW and slope happen
+    seconds = {}
+    for factor, source in sources.items():
+        start = time.perf_counter()
+        ratings[factor] = source.read(xoff, yoff, width, height)
+        seconds[factor] = time.perf_counter() - start
+        valid &= ratings[factor] != RATING_NODATA
+        index += ratings[factor].astype(accumulator) * accumulator(weights[factor])
+    index[~valid] = INDEX_NODATA
+    index = index.astype(dtype, copy=False)
+    return window, index, ratings, [output.compute(window, ratings, index, valid) for output in outputs], seconds
+
+
+def _map_bounded(pool: ThreadPoolExecutor, func, items, max_in_flight: int):
+    """pool.map that keeps at most max_in_flight results in memory, in order."""
+    in_flight = deque()
+    for item in items:
+        in_flight.append(pool.submit(func, item))
+        if len(in_flight) >= max_in_flight:
+            yield in_flight.popleft().result()
+    while in_flight:
+        yield in_flight.popleft().result()
+
+
+def weighted_overlay(
+    sources: dict[str, RatingSource],
+    out_path: str,
+    weights: dict[str, float] = DRASTIC_WEIGHTS,
+    constant: float = DRASTIC_CONSTANT,
+    factor_paths: Optional[dict[str, list[str]]] = None,
+    outputs: Optional[list[OverlayOutput]] = None,
+    tile_size: int = 0,
+    max_workers: Optional[int] = None,
+    feedback: Optional[QgsProcessingFeedback] = None,
+    raster_format: Optional[RasterFormat] = None,
+    max_rating: int = RATING_MAX,
+    report: Optional["RunReport"] = None,
+) -> str:
+    """Rate every factor and accumulate the weighted index in one pass.
+
+    A pixel is nodata in the index as soon as one factor is nodata there.
+    factor_paths optionally maps factors to the files their ratings are also
+    written to, and outputs are fed every window of the pass. The index is
+    written in raster_format, the factors in FACTOR_FORMAT. Ratings are
+    written as uint8 and the index in the type index_dtype picks for
+    max_rating, the highest rating any source can give.
+
+    The grid is cut into windows of tile_size pixels (BLOCK_SIZE by default)
+    which are computed on a pool of max_workers threads (one per CPU core by
+    default) and written into the output in order as they complete, so
+    memory is bounded by the window size and not the extent. Sources with a
+    halo read it themselves, which keeps window seams exact.
+
+    report, when given, gets the time summed over windows that each factor
+    took to read and rate, and the time spent writing.
+    """
+    like = next(iter(sources.values())).dataset
+    raster_format = raster_format or RasterFormat()
+    dtype = index_dtype(weights, constant, max_rating)
+    out = raster_format.create(out_path, like, GDAL_TYPES[dtype], INDEX_NODATA)
+    out_band = out.GetRasterBand(1)
+    factor_outputs = {
+        factor: [FACTOR_FORMAT.create(path, like, gdal.GDT_Byte, RATING_NODATA) for path in paths]
+        for factor, paths in (factor_paths or {}).items()
+    }
+
+    outputs = outputs or []
+    for output in outputs:
+        output.open(like)
+
+    windows = list(iter_blocks(like.RasterXSize, like.RasterYSize, tile_size or BLOCK_SIZE))
+    compute = partial(_overlay_window, sources, weights, constant, dtype, outputs)
+
+    busy = dict.fromkeys(sources, 0.0)
+    busy["write"] = 0.0
+
+    def write(n, window, index, ratings, results, seconds):
+        start = time.perf_counter()
+        for factor, elapsed in seconds.items():
+            busy[factor] += elapsed
+        xoff, yoff = window[:2]
+        out_band.WriteArray(index, xoff, yoff)
+        for factor, datasets in factor_outputs.items():
+            for dataset in datasets:
+                dataset.GetRasterBand(1).WriteArray(ratings[factor], xoff, yoff)
+        for output, result in zip(outputs, results):
+            output.write(window, result)
+        busy["write"] += time.perf_counter() - start
+        if feedback is not None:
+            feedback.setProgress(100 * (n + 1) / len(windows))
+
+    # IDW, slope and the ratings are computed per window, so the windows are
+    # what keeps every core busy
+    written = 0
+    workers = max(1, max_workers or os.cpu_count() or 1)
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        for n, result in enumerate(_map_bounded(pool, compute, windows, 2 * workers)):
+            write(n, *result)
+            written += 1
+            if feedback is not None and feedback.isCanceled():
+                break
+    completed = written == len(windows)
+
+    out_band = None
+    start = time.perf_counter()
+    if completed:
+        raster_format.finish(out, out_path, "AVERAGE")
+    out = None
+    (raster_format.publish if completed else raster_format.discard)(out_path)
+    factor_outputs = None
+    for output in outputs:
+        output.close(completed)
+    busy["write"] += time.perf_counter() - start
+
+    if report is not None:
+        pixels = like.RasterXSize * like.RasterYSize
+        for name, elapsed in busy.items():
+            report.add(f"overlay {name}", busy_s=round(elapsed, 3), pixels=pixels)
+    return out_path
+
+
+#------------------------------------------------------IDW------------------------------------------------------
+
+# Upper bound on the number of pixel-to-well distances held at once
+IDW_CHUNK = 1 << 21
+
+
+WELL_AGGREGATIONS = ("None (every observation)", "Median", "Latest", "Mean")
+# Features read before filtering them as one array
+POINT_CHUNK = 100_000
+
+
+def _day(value) -> Optional[int]:
+    """Ordinal day of a date attribute (QDate, QDateTime, date or ISO text)."""
+    if value is None or value == NULL:
+        return None
+    for convert in ("toPyDateTime", "toPyDate"):
+        if hasattr(value, convert):
+            if not value.isValid():
+                return None
+            value = getattr(value, convert)()
+            break
+    if isinstance(value, str):
+        try:
+            value = datetime.fromisoformat(value.strip())
+        except ValueError:
+            return None
+    try:
+        return value.toordinal()
+    except AttributeError:
+        return None
+
+
+def aggregate_observations(wells: np.ndarray, xy: np.ndarray, values: np.ndarray, days: Optional[np.ndarray], how: int):
+    """One point per well: median, latest (needs days) or mean of its values.
+
+    wells holds an integer code per observation. A well sits at the mean
+    position of its observations.
+    """
+    codes, group = np.unique(wells, return_inverse=True)
+    counts = np.bincount(group)
+    position = np.column_stack([np.bincount(group, xy[:, k]) / counts for k in range(2)])
+    if how == 3:
+        return position, np.bincount(group, values) / counts
+    if how == 2:
+        # Last observation of each group once sorted by group then day
+        order = np.lexsort((days, group))
+        last = np.cumsum(counts) - 1
+        return position, values[order][last]
+    order = np.lexsort((values, group))
+    sorted_values = values[order]
+    first = np.cumsum(counts) - counts
+    low = sorted_values[first + (counts - 1) // 2]
+    high = sorted_values[first + counts // 2]
+    return position, (low + high) / 2
+
+
+def thin_points(xy: np.ndarray, values: np.ndarray, distance: float):
+    """Merge points closer than distance to each other into their mean.
+
+    Merging is transitive: points joined by a chain of points, each closer
+    than distance to the next, become one. Close pairs come from a KD-tree,
+    or from a brute-force search in chunks without scipy, and the groups
+    from label propagation over the pairs.
+    """
+    n = len(xy)
+    if n < 2:
+        return xy, values
+    if cKDTree is not None:
+        pairs = cKDTree(xy).query_pairs(distance, output_type="ndarray").reshape(-1, 2)
+    else:
+        found = []
+        chunk = max(1, IDW_CHUNK // n)
+        for start in range(0, n, chunk):
+            rows = np.arange(start, min(start + chunk, n))
+            near = np.hypot(xy[rows, 0, None] - xy[None, :, 0], xy[rows, 1, None] - xy[None, :, 1]) <= distance
+            first, second = np.nonzero(near)
+            first = rows[first]
+            found.append(np.column_stack((first, second))[first < second])
+        pairs = np.concatenate(found)
+
+    # Every point ends up labelled with the lowest index of its group
+    group = np.arange(n)
+    while len(pairs):
+        before = group
+        lowest = np.minimum(group[pairs[:, 0]], group[pairs[:, 1]])
+        group = group.copy()
+        np.minimum.at(group, pairs[:, 0], lowest)
+        np.minimum.at(group, pairs[:, 1], lowest)
+        group = group[group]
+        if np.array_equal(group, before):
+            break
+    _, group = np.unique(group, return_inverse=True)
+    group = group.reshape(-1)
+    counts = np.bincount(group)
+    position = np.column_stack([np.bincount(group, xy[:, k]) / counts for k in range(2)])
+    return position, np.bincount(group, values) / counts
+
+
+def load_points(
+    source,
+    field: str,
+    crs: QgsCoordinateReferenceSystem,
+    transform_context,
+    feedback: Optional[QgsProcessingFeedback] = None,
+    well_field: str = "",
+    date_field: str = "",
+    date_window: tuple = (None, None),
+    bounds: Optional[tuple] = None,
+    aggregate: int = 0,
+    thin: float = 0,
+):
+    """Read the vertices of every feature with a value in field.
+
+    Returns (xy, values) in crs, as qgis:idwinterpolation would see them.
+    Large tables are streamed in chunks of POINT_CHUNK features, each cut
+    down to bounds and to the date window (first and last ordinal day, both
+    optional) before the next is read. aggregate, an index in
+    WELL_AGGREGATIONS, reduces the observations to one point per well,
+    identified by well_field or else by its exact position; latest needs
+    date_field. Points closer than thin are then merged.
+    """
+    index = source.fields().lookupField(field)
+    well_index = source.fields().lookupField(well_field) if well_field else -1
+    date_index = source.fields().lookupField(date_field) if date_field else -1
+    request = QgsFeatureRequest().setSubsetOfAttributes(
+        [i for i in (index, well_index, date_index) if i >= 0]
+    ).setDestinationCrs(crs, transform_context)
+    if bounds is not None:
+        # In the destination CRS, so providers can use their spatial index
+        request.setFilterRect(QgsRectangle(*bounds))
+    if aggregate == 2 and date_index < 0:
+        raise QgsProcessingException("Taking the latest observation of each well needs a date column")
+
+    first_day, last_day = date_window
+    well_codes = {}
+    chunks = []
+    rows = {"x": [], "y": [], "value": [], "well": [], "day": []}
+    observations = 0
+
+    def flush():
+        x, y = np.array(rows["x"], dtype=np.float64), np.array(rows["y"], dtype=np.float64)
+        keep = np.ones(len(x), dtype=bool)
+        day = None
+        if date_index >= 0:
+            day = np.array([np.nan if d is None else d for d in rows["day"]], dtype=np.float64)
+            if first_day is not None or last_day is not None or aggregate == 2:
+                keep &= ~np.isnan(day)
+            if first_day is not None:
+                keep &= day >= first_day
+            if last_day is not None:
+                keep &= day <= last_day
+        if bounds is not None:
+            keep &= (x >= bounds[0]) & (y >= bounds[1]) & (x <= bounds[2]) & (y <= bounds[3])
+        chunks.append((
+            np.column_stack((x, y))[keep],
+            np.array(rows["value"], dtype=np.float64)[keep],
+            np.array(rows["well"], dtype=np.int64)[keep],
+            day[keep] if day is not None else None,
+        ))
+        for column in rows.values():
+            column.clear()
+
+    for feature in source.getFeatures(request):
+        if feedback is not None and feedback.isCanceled():
+            break
+        value = feature.attribute(index)
+        if value is None or value == NULL or not feature.hasGeometry():
+            continue
+        well = feature.attribute(well_index) if well_index >= 0 else None
+        day = _day(feature.attribute(date_index)) if date_index >= 0 else None
+        for vertex in feature.geometry().vertices():
+            rows["x"].append(vertex.x())
+            rows["y"].append(vertex.y())
+            rows["value"].append(float(value))
+            # Without a well column, observations at the same spot are one well
+            key = class_key(well) if well_index >= 0 else (vertex.x(), vertex.y())
+            rows["well"].append(well_codes.setdefault(key, len(well_codes)) if aggregate else 0)
+            rows["day"].append(day)
+        if len(rows["x"]) >= POINT_CHUNK:
+            observations += len(rows["x"])
+            flush()
+    observations += len(rows["x"])
+    flush()
+
+    xy = np.concatenate([chunk[0] for chunk in chunks]).reshape(-1, 2)
+    values = np.concatenate([chunk[1] for chunk in chunks])
+    kept = len(values)
+    if aggregate and kept:
+        wells = np.concatenate([chunk[2] for chunk in chunks])
+        days = np.concatenate([chunk[3] for chunk in chunks]) if date_index >= 0 else None
+        xy, values = aggregate_observations(wells, xy, values, days, aggregate)
+    if thin > 0 and len(values):
+        xy, values = thin_points(xy, values, thin)
+    if feedback is not None and (aggregate or thin or bounds is not None or date_index >= 0):
+        feedback.pushInfo(f"Wells: {observations} observations, {kept} in the extent and date window, {len(values)} points")
+    return xy, values
+
+
+class IdwInterpolator:
+    """Inverse distance weighting of point values, evaluated in batches.
+
+    With neighbours and radius both 0 every point is used, which gives the
+    same surface as qgis:idwinterpolation. Otherwise only the neighbours
+    nearest points, and/or those within radius, are used; scipy's cKDTree
+    answers these queries when available, a brute force search otherwise.
+    Locations without any point in range are NaN.
+    """
+
+    def __init__(self, xy: np.ndarray, values: np.ndarray, power: float = 2.0, neighbours: int = 0, radius: float = 0.0):
+        if len(xy) == 0:
+            raise QgsProcessingException("No points with values to interpolate")
+        self.xy = xy
+        self.values = values
+        self.power = power
+        self.neighbours = min(neighbours, len(xy)) if neighbours else 0
+        self.radius = radius
+        self.tree = cKDTree(xy) if cKDTree is not None and (self.neighbours or radius) else None
+
+    def __call__(self, x: np.ndarray, y: np.ndarray) -> np.ndarray:
+        queries = np.column_stack((np.ravel(x), np.ravel(y)))
+        result = np.empty(len(queries))
+        per_query = self.neighbours if self.tree is not None and self.neighbours else len(self.xy)
+        chunk = max(1, IDW_CHUNK // per_query)
+        for start in range(0, len(queries), chunk):
+            result[start:start + chunk] = self._interpolate(queries[start:start + chunk])
+        return result.reshape(np.shape(x))
+
+    def _neighbours(self, queries: np.ndarray):
+        """Flat (row, distance, point) triples of the points used per query."""
+        if self.tree is not None and self.neighbours:
+            upper = self.radius if self.radius else np.inf
+            distances, points = self.tree.query(queries, k=self.neighbours, distance_upper_bound=upper)
+            distances = distances.reshape(len(queries), -1)
+            points = points.reshape(len(queries), -1)
+        elif self.tree is not None:
+            found = self.tree.query_ball_point(queries, r=self.radius)
+            counts = np.fromiter((len(p) for p in found), dtype=np.intp, count=len(found))
+            points = np.fromiter(chain.from_iterable(found), dtype=np.intp, count=int(counts.sum()))
+            rows = np.repeat(np.arange(len(queries)), counts)
+            distances = np.hypot(queries[rows, 0] - self.xy[points, 0], queries[rows, 1] - self.xy[points, 1])
+            return rows, distances, points
+        else:
+            distances = np.hypot(
+                queries[:, 0, None] - self.xy[None, :, 0],
+                queries[:, 1, None] - self.xy[None, :, 1],
+            )
+            if self.radius:
+                distances[distances > self.radius] = np.inf
+            if self.neighbours and self.neighbours < len(self.xy):
+                nearest = np.argpartition(distances, self.neighbours - 1, axis=1)[:, :self.neighbours]
+                distances = np.take_along_axis(distances, nearest, axis=1)
+                points = nearest
+            else:
+                points = np.broadcast_to(np.arange(len(self.xy)), distances.shape)
+        rows = np.broadcast_to(np.arange(len(queries))[:, None], distances.shape)
+        found = np.isfinite(distances)
+        return rows[found], distances[found], points[found]
+
+    def _interpolate(self, queries: np.ndarray) -> np.ndarray:
+        rows, distances, points = self._neighbours(queries)
+        values = self.values[points]
+        with np.errstate(divide="ignore", invalid="ignore"):
+            weights = distances ** -self.power
+            total = np.bincount(rows, weights=weights * values, minlength=len(queries))
+            norm = np.bincount(rows, weights=weights, minlength=len(queries))
+            result = total / norm
+        result[norm == 0] = np.nan
+        # A query on top of a point takes that point's value, as in QGIS;
+        # assigning in reverse makes the first coincident point win.
+        exact = distances == 0
+        if exact.any():
+            result[rows[exact][::-1]] = values[exact][::-1]
+        return result
+
+
+def _parse_candidates(text: str, kind=float) -> list:
+    """Comma or space separated non-negative numbers, as typed in a parameter."""
+    try:
+        candidates = sorted({kind(item) for item in text.replace(",", " ").split()})
+    except ValueError:
+        raise QgsProcessingException(f"Expected a list of numbers, got {text!r}")
+    if any(candidate < 0 for candidate in candidates):
+        raise QgsProcessingException(f"Expected non-negative numbers, got {text!r}")
+    return candidates
+
+
+def _loo_errors(prediction: np.ndarray, truth: np.ndarray) -> tuple:
+    """Squared and absolute error sums and count over the defined predictions."""
+    valid = np.isfinite(prediction)
+    error = prediction[valid] - truth[valid]
+    return (error ** 2).sum(), np.abs(error).sum(), valid.sum()
+
+
+def cross_validate_idw(
+    xy: np.ndarray,
+    values: np.ndarray,
+    powers: list[float],
+    neighbour_counts: list[int],
+    radius: float = 0.0,
+) -> list[dict]:
+    """Leave-one-out RMSE and MAE of IDW for every power and neighbour count.
+
+    Each point is predicted from the others. One neighbour query, on a
+    KD-tree when scipy is available, serves every bounded neighbour count:
+    for a power, the running sums of weights and weighted values along the
+    sorted neighbours give the prediction for every count at once. The
+    all-points candidate (0, or a count reaching every other point) needs
+    no sorting and is a plain weighted sum over chunks of points. Points
+    with no neighbour in radius are left out of the errors. Returns one
+    dict per candidate, best (lowest RMSE) first.
+    """
+    n = len(xy)
+    if n < 2:
+        raise QgsProcessingException("Cross-validation needs at least two points")
+    counts = [min(k, n - 1) if k else n - 1 for k in neighbour_counts]
+    bounded = sorted({k for k in counts if k < n - 1})
+    squared = np.zeros((len(powers), len(counts)))
+    absolute = np.zeros((len(powers), len(counts)))
+    used = np.zeros((len(powers), len(counts)), dtype=np.int64)
+
+    def add(i, k, errors):
+        for j, count in enumerate(counts):
+            if count == k:
+                squared[i, j] += errors[0]
+                absolute[i, j] += errors[1]
+                used[i, j] += errors[2]
+
+    if bounded:
+        depth = max(bounded)
+        tree = cKDTree(xy) if cKDTree is not None else None
+        # The tree holds depth + 1 neighbours per point, brute force every distance
+        chunk = max(1, IDW_CHUNK // (depth + 1 if tree is not None else n))
+        for start in range(0, n, chunk):
+            rows = np.arange(start, min(start + chunk, n))
+            if tree is not None:
+                distances, points = tree.query(
+                    xy[rows], k=depth + 1, distance_upper_bound=radius if radius else np.inf
+                )
+            else:
+                distances = np.hypot(xy[rows, 0, None] - xy[None, :, 0], xy[rows, 1, None] - xy[None, :, 1])
+                points = np.argsort(distances, axis=1, kind="stable")[:, :depth + 1]
+                distances = np.take_along_axis(distances, points, axis=1)
+                if radius:
+                    distances[distances > radius] = np.inf
+            # Drop each point from its own neighbours; coincident points stay
+            own = points == rows[:, None]
+            own[own.cumsum(axis=1) > 1] = False
+            keep = ~own
+            keep[own.sum(axis=1) == 0, -1] = False
+            distances = distances[keep].reshape(len(rows), depth)
+            points = points[keep].reshape(len(rows), depth)
+
+            found = np.isfinite(distances)
+            neighbour_values = np.where(found, values[np.where(found, points, 0)], 0.0)
+            exact = distances[:, 0] == 0
+            truth = values[rows]
+            for i, power in enumerate(powers):
+                with np.errstate(divide="ignore", invalid="ignore"):
+                    weights = np.where(found & (distances > 0), distances ** -power, 0.0)
+                numerator = np.cumsum(weights * neighbour_values, axis=1)
+                denominator = np.cumsum(weights, axis=1)
+                for k in bounded:
+                    with np.errstate(divide="ignore", invalid="ignore"):
+                        prediction = numerator[:, k - 1] / denominator[:, k - 1]
+                    # A neighbour on top of the point gives its value, as in IdwInterpolator
+                    prediction[exact] = neighbour_values[exact, 0]
+                    add(i, k, _loo_errors(prediction, truth))
+
+    if n - 1 in counts:
+        chunk = max(1, IDW_CHUNK // n)
+        for start in range(0, n, chunk):
+            rows = np.arange(start, min(start + chunk, n))
+            distances = np.hypot(xy[rows, 0, None] - xy[None, :, 0], xy[rows, 1, None] - xy[None, :, 1])
+            others = np.ones(distances.shape, dtype=bool)
+            others[np.arange(len(rows)), rows] = False
+            if radius:
+                others &= distances <= radius
+            on_top = others & (distances == 0)
+            exact = on_top.any(axis=1)
+            exact_values = values[np.argmax(on_top, axis=1)]
+            truth = values[rows]
+            for i, power in enumerate(powers):
+                with np.errstate(divide="ignore", invalid="ignore"):
+                    weights = np.where(others & (distances > 0), distances ** -power, 0.0)
+                    prediction = (weights @ values) / weights.sum(axis=1)
+                prediction[exact] = exact_values[exact]
+                add(i, n - 1, _loo_errors(prediction, truth))
+
+    results = []
+    for i, power in enumerate(powers):
+        for j, k in enumerate(neighbour_counts):
+            count = used[i, j]
+            results.append({
+                "power": power,
+                "neighbours": k,
+                "rmse": float(np.sqrt(squared[i, j] / count)) if count else float("nan"),
+                "mae": float(absolute[i, j] / count) if count else float("nan"),
+                "points": int(count),
+            })
+    results.sort(key=lambda result: (np.isnan(result["rmse"]), result["rmse"]))
+    return results
+
+
+class IdwRatingSource(RatingSource):
+    """D factor interpolated at the pixel centres of each block and rated.
+
+    open_dataset only has to describe the grid, see TargetGrid.dataset.
+    """
+
+    def __init__(self, open_dataset, interpolator: IdwInterpolator, rate):
+        super().__init__(open_dataset, rate)
+        self.interpolator = interpolator
+
+    def read(self, xoff: int, yoff: int, width: int, height: int) -> np.ndarray:
+        x0, dx, _, y0, _, dy = self.dataset.GetGeoTransform()
+        x = x0 + (xoff + np.arange(width) + 0.5) * dx
+        y = y0 + (yoff + np.arange(height) + 0.5) * dy
+        depth = self.interpolator(*np.meshgrid(x, y))
+        return self.rate(depth, nodata=None)
+
+
+#------------------------------------------------------Class rasters------------------------------------------------------
+
+CLASS_NODATA = 0
+
+
+# A number written with a decimal point, as CSV files and text fields hold reals
+DECIMAL_TEXT = re.compile(r"[+-]?(\d+\.\d*|\.\d+)")
+
+
+def class_key(value) -> Optional[str]:
+    """Normalise an attribute or CSV value so 3, 3.0, "3.0" and "3 " all match.
+
+    Text with a decimal point is read as the real it writes, so "2.50" and
+    2.5 match too; other text is only stripped, which keeps codes such as
+    "03" apart from 3.
+    """
+    if value is None or value == NULL:
+        return None
+    if isinstance(value, str):
+        value = value.strip()
+        if not DECIMAL_TEXT.fullmatch(value):
+            return value
+        value = float(value)
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return str(value)
+
+
+def _dense_code(key: Optional[str]) -> int:
+    """The code of a key written as class_key writes integers, -1 otherwise."""
+    if key is None or not key.isdecimal() or key != str(int(key)):
+        return -1
+    return int(key)
+
+
+class ReclassTable:
+    """A validated IN_/OUT reclassification table.
+
+    mapping holds OUT, a whole rating, by class_key(IN_). When every IN_ is a non-negative
+    integer code written without leading zeros, as class_key writes them, the
+    table is also compiled to dense, an array indexed by code with
+    RATING_NODATA for the missing ones.
+    """
+
+    # Largest code for which a dense array is built
+    DENSE_LIMIT = 1 << 20
+
+    def __init__(self, path: str, mapping: dict[str, int], digest: str = ""):
+        self.path = path
+        self.mapping = mapping
+        self.digest = digest
+        self.dense = None
+        codes = [code for code in map(_dense_code, mapping) if code >= 0]
+        if mapping and len(codes) == len(mapping) and max(codes) < self.DENSE_LIMIT:
+            self.dense = np.full(max(codes) + 1, RATING_NODATA, dtype=RATING_DTYPE)
+            self.dense[codes] = [mapping[key] for key in mapping]
+
+    @classmethod
+    def from_csv(cls, path: str) -> "ReclassTable":
+        """Parse a ';' or ',' separated CSV with IN_ and OUT columns."""
+        with open(path, 'rb') as csvfile:
+            content = csvfile.read()
+        text = content.decode('utf-8-sig')
+        lines = text.splitlines()
+        if not lines:
+            raise QgsProcessingException(f"{path}: the reclassification CSV is empty")
+        delimiter = ';' if ';' in lines[0] else ','
+        reader = csv.reader(lines, delimiter=delimiter)
+        headers = [header.strip() for header in next(reader)]
+        if "IN_" not in headers or "OUT" not in headers:
+            raise QgsProcessingException(f"{path}: the reclassification CSV needs IN_ and OUT columns, found {headers}")
+        in_column, out_column = headers.index("IN_"), headers.index("OUT")
+
+        mapping = {}
+        for line, row in enumerate(reader, start=2):
+            if not any(cell.strip() for cell in row):
+                continue
+            try:
+                key, value = class_key(row[in_column]), float(row[out_column])
+            except (IndexError, ValueError):
+                raise QgsProcessingException(f"{path}, line {line}: expected an IN_ value and a numeric OUT, got {row}")
+            if not value.is_integer() or not RATING_NODATA <= value <= np.iinfo(RATING_DTYPE).max:
+                raise QgsProcessingException(f"{path}, line {line}: OUT must be a whole rating from 0 to 255, got {row[out_column]}")
+            value = int(value)
+            if mapping.get(key, value) != value:
+                raise QgsProcessingException(f"{path}, line {line}: IN_ {key} is mapped to both {mapping[key]} and {value}")
+            mapping[key] = value
+        return cls(path, mapping, hashlib.sha1(content).hexdigest())
+
+    @property
+    def max_rating(self) -> int:
+        return max(self.mapping.values(), default=RATING_NODATA)
+
+    def lookup(self, keys: list) -> np.ndarray:
+        """Ratings for a list of class keys, RATING_NODATA when unmapped."""
+        if self.dense is not None:
+            codes = np.fromiter(
+                # Other keys, "03" among them, are in no dense table's mapping either
+                map(_dense_code, keys),
+                dtype=np.int64,
+                count=len(keys),
+            )
+            inside = (codes >= 0) & (codes < len(self.dense))
+            ratings = np.full(len(keys), RATING_NODATA, dtype=RATING_DTYPE)
+            ratings[inside] = self.dense[codes[inside]]
+            return ratings
+        return np.fromiter((self.mapping.get(key, RATING_NODATA) for key in keys), dtype=RATING_DTYPE, count=len(keys))
+
+
+# Parsed tables by absolute path, with the (mtime, size) they were read at
+_reclass_tables: dict[str, tuple] = {}
+_reclass_tables_lock = threading.Lock()
+
+
+def load_reclass_table(path: str) -> ReclassTable:
+    """ReclassTable for path, parsed only when the file changed since last time."""
+    path = os.path.abspath(path)
+    stat = os.stat(path)
+    signature = (stat.st_mtime_ns, stat.st_size)
+    with _reclass_tables_lock:
+        cached = _reclass_tables.get(path)
+        if cached is not None and cached[0] == signature:
+            return cached[1]
+    table = ReclassTable.from_csv(path)
+    with _reclass_tables_lock:
+        _reclass_tables[path] = (signature, table)
+    return table
+
+
+def _quote(identifier: str) -> str:
+    return '"' + identifier.replace('"', '""') + '"'
+
+
+def rasterize_classes(source_uri: str, fields: list[str], grid_like, path: str):
+    """Burn the distinct combinations of fields as integer class ids.
+
+    Class ids run from 1 in the sort order of the combinations and
+    CLASS_NODATA marks pixels outside every polygon. The ids are computed by
+    OGR's SQLite dialect (DENSE_RANK needs SQLite 3.25), so the source is
+    read once, as is, and never modified. Returns the class raster path and
+    the list of keys, keys[id - 1] being the class_key tuple of class id.
+    """
+    parts = QgsProviderRegistry.instance().decodeUri('ogr', source_uri)
+    vector = ogr.Open(parts.get('path') or source_uri)
+    if vector is None:
+        raise QgsProcessingException(f"Could not open vector layer {source_uri}")
+    layer = vector.GetLayerByName(parts['layerName']) if parts.get('layerName') else vector.GetLayer(0)
+    columns = ", ".join(_quote(field) for field in fields)
+    table = _quote(layer.GetName())
+
+    distinct = vector.ExecuteSQL(f"SELECT DISTINCT {columns} FROM {table} ORDER BY {columns}", dialect="SQLITE")
+    keys = [
+        tuple(class_key(feature.GetField(i)) for i in range(len(fields)))
+        for feature in distinct
+    ]
+    vector.ReleaseResultSet(distinct)
+
+    data_type = gdal.GDT_UInt16 if len(keys) < 65535 else gdal.GDT_UInt32
+    target = create_raster(path, grid_like, data_type, CLASS_NODATA)
+    target.GetRasterBand(1).Fill(CLASS_NODATA)
+    result = gdal.Rasterize(
+        target,
+        vector,
+        SQLStatement=f"SELECT *, DENSE_RANK() OVER (ORDER BY {columns}) AS drastic_class FROM {table}",
+        SQLDialect="SQLITE",
+        attribute="drastic_class",
+    )
+    if result is None:
+        raise QgsProcessingException(f"Could not rasterize {source_uri}")
+    target = None
+    result = None
+    return path, keys
+
+
+def class_lut(keys: list[tuple], position: int, table: ReclassTable) -> np.ndarray:
+    """Ratings per class id for the key at position, RATING_NODATA when unmapped."""
+    lut = np.full(len(keys) + 1, RATING_NODATA, dtype=RATING_DTYPE)
+    lut[1:] = table.lookup([key[position] for key in keys])
+    return lut
+
+
+def rate_by_lookup(lut: np.ndarray):
+    """Build a rating function for RatingSource over a class id raster."""
+    return lambda values, nodata=None: lut[values]
+
+
+#------------------------------------------------------Zones------------------------------------------------------
+
+ZONE_NODATA = 0
+
+
+def rasterize_zones(source, crs: QgsCoordinateReferenceSystem, transform_context, grid_like, path: str, feedback=None):
+    """Burn each feature of source with its own zone id, from 1 in read order.
+
+    Geometries are reprojected to crs into an in-memory OGR layer, so any
+    QGIS source works and the zones are read once. Where zones overlap the
+    one read last wins. Returns the zone raster path and the features,
+    features[id - 1] being the feature of zone id.
+    """
+    srs = osr.SpatialReference()
+    srs.SetFromUserInput(crs.authid() or crs.toWkt())
+    memory = ogr.GetDriverByName("Memory").CreateDataSource("")
+    layer = memory.CreateLayer("zones", srs, ogr.wkbUnknown)
+    layer.CreateField(ogr.FieldDefn("drastic_zone", ogr.OFTInteger))
+    definition = layer.GetLayerDefn()
+    transform = QgsCoordinateTransform(source.sourceCrs(), crs, transform_context)
+
+    features = []
+    for feature in source.getFeatures():
+        if feedback is not None and feedback.isCanceled():
+            break
+        features.append(feature)
+        if not feature.hasGeometry():
+            continue
+        geometry = feature.geometry()
+        geometry.transform(transform)
+        zone = ogr.Feature(definition)
+        zone.SetField(0, len(features))
+        zone.SetGeometry(ogr.CreateGeometryFromWkb(bytes(geometry.asWkb())))
+        layer.CreateFeature(zone)
+
+    data_type = gdal.GDT_UInt16 if len(features) < 65535 else gdal.GDT_UInt32
+    target = create_raster(path, grid_like, data_type, ZONE_NODATA)
+    target.GetRasterBand(1).Fill(ZONE_NODATA)
+    if gdal.RasterizeLayer(target, [1], layer, options=["ATTRIBUTE=drastic_zone"]) != 0:
+        raise QgsProcessingException("Could not rasterize the zones")
+    target = None
+    return path, features
+
+
+class ZonalOutput(OverlayOutput):
+    """Index statistics per zone, accumulated window by window.
+
+    Every window contributes the pixel count, sum, minimum and maximum of
+    the index and the pixel count per vulnerability class of each zone it
+    touches, found by sorting the window once by zone; nothing is read per
+    zone, so the cost does not depend on the number of zones.
+    """
+
+    def __init__(self, open_zones, zones: int, breaks: tuple = VULNERABILITY_BREAKS):
+        self.zone_source = RatingSource(open_zones)
+        self.breaks = np.asarray(breaks, dtype=np.float64)
+        classes = len(breaks) + 1
+        self.count = np.zeros(zones + 1, dtype=np.int64)
+        self.sum = np.zeros(zones + 1)
+        self.min = np.full(zones + 1, np.inf)
+        self.max = np.full(zones + 1, -np.inf)
+        self.class_count = np.zeros((zones + 1, classes), dtype=np.int64)
+
+    def open(self, like):
+        geotransform = like.GetGeoTransform()
+        self.pixel_area = abs(geotransform[1] * geotransform[5])
+
+    def compute(self, window, ratings, index, valid):
+        band = self.zone_source.dataset.GetRasterBand(1)
+        zones = band.ReadAsArray(*window)
+        use = valid & (zones != ZONE_NODATA)
+        zones = zones[use].astype(np.int64)
+        values = index[use].astype(np.float64)
+        if not len(zones):
+            return None
+        order = np.lexsort((values, zones))
+        zones, values = zones[order], values[order]
+        last = np.flatnonzero(np.append(zones[1:] != zones[:-1], True))
+        first = np.append(0, last[:-1] + 1)
+        classes = np.digitize(values, self.breaks)
+        keys, counts = np.unique(zones * (len(self.breaks) + 1) + classes, return_counts=True)
+        return (
+            zones[first],
+            last - first + 1,
+            np.add.reduceat(values, first),
+            values[first],
+            values[last],
+            keys,
+            counts,
+        )
+
+    def write(self, window, result):
+        if result is None:
+            return
+        present, count, total, low, high, keys, counts = result
+        self.count[present] += count
+        self.sum[present] += total
+        self.min[present] = np.minimum(self.min[present], low)
+        self.max[present] = np.maximum(self.max[present], high)
+        self.class_count.reshape(-1)[keys] += counts
+
+    def rows(self) -> list[tuple]:
+        """(pixels, mean, min, max, area per class) for zones 1, 2, ..."""
+        rows = []
+        for zone in range(1, len(self.count)):
+            count = int(self.count[zone])
+            if count:
+                statistics = (self.sum[zone] / count, float(self.min[zone]), float(self.max[zone]))
+            else:
+                statistics = (None, None, None)
+            areas = tuple(float(c) * self.pixel_area for c in self.class_count[zone])
+            rows.append((count,) + statistics + areas)
+        return rows
+
+
+#------------------------------------------------------Factor stack------------------------------------------------------
+
+# Side of the square chunks of a factor stack, in pixels
+STACK_CHUNK = 256
+STACK_METADATA = "factor_stack.json"
+STACK_RATINGS = "ratings.npy"
+STACK_VERSION = 1
+
+
+class FactorStack:
+    """The ratings of every factor on the grid, chunked and memory-mapped.
+
+    A stack is a folder holding the grid, factors, weights and constant in
+    factor_stack.json and the ratings in ratings.npy, a uint8 array shaped
+    (chunk rows, chunk cols, factors, chunk, chunk): each chunk holds every
+    factor of a square of pixels contiguously, so a window of all factors
+    is a few contiguous reads. The array is memory-mapped, so opening a
+    stack reads nothing but the metadata and a window only touches the
+    chunks under it. Chunks over the edge of the grid are padded with
+    RATING_NODATA. The metadata is written last, on close, so a folder
+    without it is an incomplete stack.
+    """
+
+    def __init__(self, folder: str, metadata: dict, ratings: np.ndarray):
+        self.folder = folder
+        self.metadata = metadata
+        self.ratings = ratings
+        self.factors = list(metadata["factors"])
+        self.chunk = metadata["chunk"]
+        self.cols = metadata["cols"]
+        self.rows = metadata["rows"]
+        self.grid = TargetGrid(tuple(metadata["bounds"]), metadata["pixel"], metadata["crs"])
+
+    @classmethod
+    def create(
+        cls,
+        folder: str,
+        like,
+        factors=FACTORS,
+        weights: Optional[dict[str, float]] = None,
+        constant: float = DRASTIC_CONSTANT,
+        chunk: int = STACK_CHUNK,
+    ) -> "FactorStack":
+        """An empty stack on the grid of the dataset like, open for writing."""
+        os.makedirs(folder, exist_ok=True)
+        metadata_path = os.path.join(folder, STACK_METADATA)
+        if os.path.exists(metadata_path):
+            os.remove(metadata_path)
+        xmin, pixel, _, ymax, _, _ = like.GetGeoTransform()
+        cols, rows = like.RasterXSize, like.RasterYSize
+        metadata = {
+            "version": STACK_VERSION,
+            "factors": list(factors),
+            "weights": {f: (weights or DRASTIC_WEIGHTS)[f] for f in factors},
+            "constant": constant,
+            "chunk": chunk,
+            "cols": cols,
+            "rows": rows,
+            "bounds": [xmin, ymax - rows * pixel, xmin + cols * pixel, ymax],
+            "pixel": pixel,
+            "crs": like.GetProjection(),
+            "nodata": RATING_NODATA,
+        }
+        # A new .npy is filled with zeros, which is RATING_NODATA, by the OS
+        ratings = np.lib.format.open_memmap(
+            os.path.join(folder, STACK_RATINGS),
+            mode="w+",
+            dtype=RATING_DTYPE,
+            shape=(math.ceil(rows / chunk), math.ceil(cols / chunk), len(factors), chunk, chunk),
+        )
+        return cls(folder, metadata, ratings)
+
+    @classmethod
+    def open(cls, folder: str) -> "FactorStack":
+        """A complete stack, memory-mapped read only."""
+        try:
+            with open(os.path.join(folder, STACK_METADATA), encoding="utf-8") as metadata_file:
+                metadata = json.load(metadata_file)
+        except (OSError, ValueError) as e:
+            raise QgsProcessingException(f"{folder} is not a complete factor stack: {e}")
+        if metadata.get("version") != STACK_VERSION:
+            raise QgsProcessingException(f"{folder}: unsupported factor stack version {metadata.get('version')}")
+        return cls(folder, metadata, np.load(os.path.join(folder, STACK_RATINGS), mmap_mode="r"))
+
+    def close(self, completed: bool = True):
+        """Flush the ratings, then write the metadata that completes the stack.
+
+        A stack closed with completed false keeps no metadata, so it can
+        never be opened half filled.
+        """
+        if isinstance(self.ratings, np.memmap) and self.ratings.mode != "r":
+            self.ratings.flush()
+            if completed:
+                with open(os.path.join(self.folder, STACK_METADATA), "w", encoding="utf-8") as metadata_file:
+                    json.dump(self.metadata, metadata_file, indent=2)
+        self.ratings = None
+
+    def _pieces(self, xoff: int, yoff: int, width: int, height: int):
+        """(chunk row, chunk col, slices in the chunk, slices in the window) under a window."""
+        c = self.chunk
+        for row in range(yoff // c, (yoff + height - 1) // c + 1):
+            y0, y1 = max(yoff, row * c), min(yoff + height, (row + 1) * c)
+            for col in range(xoff // c, (xoff + width - 1) // c + 1):
+                x0, x1 = max(xoff, col * c), min(xoff + width, (col + 1) * c)
+                yield (
+                    row,
+                    col,
+                    (slice(y0 - row * c, y1 - row * c), slice(x0 - col * c, x1 - col * c)),
+                    (slice(y0 - yoff, y1 - yoff), slice(x0 - xoff, x1 - xoff)),
+                )
+
+    def read(self, xoff: int, yoff: int, width: int, height: int, factors=None) -> np.ndarray:
+        """Ratings of factors (all by default) in a window, shaped (factors, height, width)."""
+        planes = [self.factors.index(f) for f in factors] if factors is not None else slice(None)
+        out = np.empty((len(factors or self.factors), height, width), dtype=RATING_DTYPE)
+        for row, col, (chunk_y, chunk_x), (out_y, out_x) in self._pieces(xoff, yoff, width, height):
+            out[:, out_y, out_x] = self.ratings[row, col, planes, chunk_y, chunk_x]
+        return out
+
+    def write(self, xoff: int, yoff: int, ratings: np.ndarray):
+        """Store ratings shaped (factors, height, width) at a window."""
+        _, height, width = ratings.shape
+        for row, col, (chunk_y, chunk_x), (out_y, out_x) in self._pieces(xoff, yoff, width, height):
+            self.ratings[row, col, :, chunk_y, chunk_x] = ratings[:, out_y, out_x]
+
+    def sources(self) -> dict[str, "StackRatingSource"]:
+        """A RatingSource per factor, to overlay or sample the stack."""
+        return {f: StackRatingSource(self, f) for f in self.factors}
+
+
+class StackRatingSource(RatingSource):
+    """One factor of a FactorStack, read like any other rating source."""
+
+    def __init__(self, stack: FactorStack, factor: str):
+        super().__init__(stack.grid.dataset)
+        self.stack = stack
+        self.factor = factor
+
+    def read(self, xoff: int, yoff: int, width: int, height: int) -> np.ndarray:
+        return self.stack.read(xoff, yoff, width, height, [self.factor])[0]
+
+
+class FactorStackOutput(OverlayOutput):
+    """Writes the ratings of every window of the overlay into a FactorStack."""
+
+    def __init__(self, folder: str, weights: dict[str, float], constant: float, chunk: int = STACK_CHUNK):
+        self.folder = folder
+        self.weights = weights
+        self.constant = constant
+        self.chunk = chunk
+
+    def open(self, like):
+        self.stack = FactorStack.create(self.folder, like, FACTORS, self.weights, self.constant, self.chunk)
+
+    def compute(self, window, ratings, index, valid):
+        return np.stack([ratings[f] for f in FACTORS])
+
+    def write(self, window, result):
+        self.stack.write(window[0], window[1], result)
+
+    def close(self, completed: bool = True):
+        self.stack.close(completed)
+        self.stack = None
+
+
+#------------------------------------------------------Point queries------------------------------------------------------
+
+
+def open_factor_rasters(folder: str) -> dict[str, RatingSource]:
+    """RatingSources over the factor rasters kept in an output folder (d.tif, r.tif, ...)."""
+    paths = {f: os.path.join(folder, f"{f.lower()}.tif") for f in FACTORS}
+    missing = [path for path in paths.values() if not os.path.exists(path)]
+    if missing:
+        raise QgsProcessingException(f"Missing factor rasters (run with the intermediates kept): {', '.join(missing)}")
+    return {f: RatingSource(partial(gdal.Open, path)) for f, path in paths.items()}
+
+
+def query_points(
+    source,
+    xy: np.ndarray,
+    weights: Optional[dict[str, float]] = None,
+    constant: Optional[float] = None,
+    block: int = STACK_CHUNK,
+) -> dict[str, np.ndarray]:
+    """Ratings of every factor and the index at many points, in one call.
+
+    source is a FactorStack or a dict of RatingSource by factor on one grid
+    (see open_factor_rasters), and xy an (n, 2) array of coordinates in the
+    grid CRS. Points are sorted by block so each block is read once: a
+    stack is gathered straight from its memory map, other sources are read
+    block by block. weights and constant default to the ones stored in the
+    stack, or DRASTIC_WEIGHTS and DRASTIC_CONSTANT.
+
+    Returns the ratings by factor, the index and the pixel col and row of
+    every point, in the order given; points off the grid or on a nodata
+    factor get RATING_NODATA ratings and an INDEX_NODATA index.
+    """
+    if isinstance(source, FactorStack):
+        factors = source.factors
+        geotransform, cols, rows = source.grid.geotransform, source.cols, source.rows
+        weights = weights or source.metadata["weights"]
+        constant = source.metadata["constant"] if constant is None else constant
+    else:
+        factors = list(source)
+        like = next(iter(source.values())).dataset
+        geotransform, cols, rows = like.GetGeoTransform(), like.RasterXSize, like.RasterYSize
+        weights = weights or DRASTIC_WEIGHTS
+        constant = DRASTIC_CONSTANT if constant is None else constant
+    missing = [f for f in FACTORS if f not in factors]
+    if missing:
+        raise QgsProcessingException(f"No ratings for {', '.join(missing)}")
+
+    xy = np.asarray(xy, dtype=np.float64).reshape(-1, 2)
+    col = np.floor((xy[:, 0] - geotransform[0]) / geotransform[1]).astype(np.int64)
+    row = np.floor((xy[:, 1] - geotransform[3]) / geotransform[5]).astype(np.int64)
+    inside = (col >= 0) & (col < cols) & (row >= 0) & (row < rows)
+    ratings = np.full((len(factors), len(xy)), RATING_NODATA, dtype=RATING_DTYPE)
+
+    points = np.flatnonzero(inside)
+    if isinstance(source, FactorStack):
+        c = source.chunk
+        blocks_x = math.ceil(cols / c)
+        points = points[np.argsort((row[points] // c) * blocks_x + col[points] // c, kind="stable")]
+        r, q = row[points], col[points]
+        ratings[:, points] = source.ratings[r // c, q // c, :, r % c, q % c].T
+    elif len(points):
+        blocks_x = math.ceil(cols / block)
+        keys = (row[points] // block) * blocks_x + col[points] // block
+        order = np.argsort(keys, kind="stable")
+        points, keys = points[order], keys[order]
+        starts = np.flatnonzero(np.append(True, keys[1:] != keys[:-1]))
+        for start, end in zip(starts, np.append(starts[1:], len(points))):
+            members = points[start:end]
+            xoff, yoff = (keys[start] % blocks_x) * block, (keys[start] // blocks_x) * block
+            width, height = min(block, cols - xoff), min(block, rows - yoff)
+            for k, f in enumerate(factors):
+                window = source[f].read(int(xoff), int(yoff), int(width), int(height))
+                ratings[k, members] = window[row[members] - yoff, col[members] - xoff]
+
+    results = {f: ratings[factors.index(f)] for f in FACTORS}
+    valid = inside & np.all(np.stack([results[f] for f in FACTORS]) != RATING_NODATA, axis=0)
+    index = constant + sum(weights[f] * results[f].astype(np.float64) for f in FACTORS)
+    dtype = index_dtype(weights, constant, int(ratings.max(initial=RATING_MAX)))
+    results["index"] = np.where(valid, index, INDEX_NODATA).astype(dtype)
+    results["col"] = np.where(inside, col, -1)
+    results["row"] = np.where(inside, row, -1)
+    return results
+
+
+def query_layer(source, factors, transform_context, weights=None, constant=None, feedback=None) -> tuple:
+    """query_points at every point of a feature source, taken to the grid CRS.
+
+    Multipart features are queried at their first point. Returns the
+    feature ids and the results of query_points in the same order.
+    """
+    if isinstance(factors, FactorStack):
+        crs = factors.grid.crs
+    else:
+        crs = next(iter(factors.values())).dataset.GetProjection()
+    request = QgsFeatureRequest().setNoAttributes().setDestinationCrs(
+        QgsCoordinateReferenceSystem.fromWkt(crs), transform_context
+    )
+    ids, xy = [], []
+    for feature in source.getFeatures(request):
+        if feedback is not None and feedback.isCanceled():
+            break
+        if not feature.hasGeometry():
+            continue
+        vertex = next(feature.geometry().vertices())
+        ids.append(feature.id())
+        xy.append((vertex.x(), vertex.y()))
+    return np.array(ids, dtype=np.int64), query_points(factors, np.array(xy).reshape(-1, 2), weights, constant)
+
+
+#------------------------------------------------------Stage cache------------------------------------------------------
+
+# Bump when the content of cached factor rasters changes
+CACHE_VERSION = 8
+
+# Side files that carry the data of a shapefile
+SHAPEFILE_PARTS = (".shp", ".shx", ".dbf", ".prj", ".cpg")
+
+
+# Side files SQLite based formats (GeoPackage, SpatiaLite) keep recent edits in
+SQLITE_SIDE_FILES = ("-wal", "-shm")
+
+
+def file_identity(source_uri: str, provider: str = "ogr") -> Optional[list]:
+    """The source string plus size and mtime of the files behind it.
+
+    provider is the data provider of the layer (layer.providerType()), which
+    decodes the source into its file. None when no file backs the source
+    (a database or memory layer...): nothing then tells whether its data
+    changed, so what depends on it must not be cached.
+    """
+    parts = QgsProviderRegistry.instance().decodeUri(provider, source_uri)
+    path = parts.get("path")
+    if not path or not os.path.isfile(path):
+        return None
+    stem, extension = os.path.splitext(path)
+    files = [stem + part for part in SHAPEFILE_PARTS] if extension.lower() == ".shp" else [path]
+    files += [path + side for side in SQLITE_SIDE_FILES]
+    identity = [source_uri]
+    for name in files:
+        if os.path.exists(name):
+            stat = os.stat(name)
+            identity.append((os.path.abspath(name), stat.st_size, stat.st_mtime_ns))
+    return identity
+
+
+class StageCache:
+    """Factor rasters of earlier runs, keyed by a hash of the stage inputs.
+
+    Entries are <key>.tif files in folder. Reading an entry refreshes its
+    mtime, and evict() removes the least recently used entries until the
+    folder holds at most max_bytes.
+    """
+
+    def __init__(self, folder: str, max_bytes: int):
+        self.folder = folder
+        self.max_bytes = max_bytes
+        os.makedirs(folder, exist_ok=True)
+
+    @staticmethod
+    def key(*parts) -> str:
+        text = json.dumps([CACHE_VERSION, *parts], sort_keys=True, default=str)
+        return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+    def path(self, key: str) -> str:
+        return os.path.join(self.folder, f"{key}.tif")
+
+    def get(self, key: str) -> Optional[str]:
+        path = self.path(key)
+        if not os.path.exists(path):
+            return None
+        os.utime(path)
+        return path
+
+    def pending_path(self, key: str) -> str:
+        """Where to write an entry before store() publishes it."""
+        return os.path.join(self.folder, f"{key}.partial.tif")
+
+    def store(self, key: str) -> str:
+        path = self.path(key)
+        os.replace(self.pending_path(key), path)
+        return path
+
+    def evict(self):
+        entries = []
+        for name in os.listdir(self.folder):
+            path = os.path.join(self.folder, name)
+            if name.endswith(".tif") and not name.endswith(".partial.tif"):
+                stat = os.stat(path)
+                entries.append((stat.st_mtime, stat.st_size, path))
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            os.remove(path)
+            total -= size
+
+
+#------------------------------------------------------Run report------------------------------------------------------
+
+def peak_rss_mb() -> Optional[float]:
+    """High-water mark of the process resident memory, in MB."""
+    if resource is not None:
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        # kB on Linux, bytes on macOS
+        return round(peak / (1 << 20) if os.uname().sysname == "Darwin" else peak / 1024, 1)
+    if psutil is not None:
+        return round(psutil.Process().memory_info().peak_wset / (1 << 20), 1)
+    return None
+
+
+def io_counters() -> Optional[tuple]:
+    """Bytes read and written by the process so far, cache hits included."""
+    try:
+        with open("/proc/self/io") as io:
+            counters = dict(line.split(": ") for line in io.read().splitlines())
+        return int(counters["rchar"]), int(counters["wchar"])
+    except (OSError, KeyError, ValueError):
+        pass
+    if psutil is not None:
+        counters = psutil.Process().io_counters()
+        return counters.read_bytes, counters.write_bytes
+    return None
+
+
+class RunReport:
+    """Wall time, CPU time, memory, I/O and pixel counts of every step of a run.
+
+    CPU time is that of the measuring thread unless process_cpu is set, for
+    steps that fan out to a pool. Memory is the process peak when the step
+    ends and I/O the process counters over the step, so steps running side
+    by side share theirs.
+    """
+
+    def __init__(self):
+        self.steps = []
+        self.lock = threading.Lock()
+        self.start = time.perf_counter()
+        self.cpu_start = time.process_time()
+
+    @contextmanager
+    def measure(self, name: str, process_cpu: bool = False, **fields):
+        """Time the body; fields and whatever it adds to the yielded dict are kept."""
+        clock = time.process_time if process_cpu else time.thread_time
+        step = {"name": name, **fields}
+        io_start = io_counters()
+        wall, cpu = time.perf_counter(), clock()
+        try:
+            yield step
+        finally:
+            step["wall_s"] = round(time.perf_counter() - wall, 3)
+            step["cpu_s"] = round(clock() - cpu, 3)
+            step["peak_rss_mb"] = peak_rss_mb()
+            io_end = io_counters()
+            if io_start is not None and io_end is not None:
+                step["read_bytes"] = io_end[0] - io_start[0]
+                step["written_bytes"] = io_end[1] - io_start[1]
+            with self.lock:
+                self.steps.append(step)
+
+    def add(self, name: str, **fields):
+        """Record a step measured by someone else."""
+        with self.lock:
+            self.steps.append({"name": name, **fields})
+
+    def to_dict(self) -> dict:
+        return {
+            "wall_s": round(time.perf_counter() - self.start, 3),
+            "cpu_s": round(time.process_time() - self.cpu_start, 3),
+            "peak_rss_mb": peak_rss_mb(),
+            "steps": self.steps,
+        }
+
+    def save(self, path: str, **extra) -> str:
+        with open(path, "w", encoding="utf-8") as report_file:
+            json.dump({**self.to_dict(), **extra}, report_file, indent=2, default=str)
+        return path
+
+    def summary(self) -> list[str]:
+        """One line per step, slowest first."""
+        lines = []
+        for step in sorted(self.steps, key=lambda step: -step.get("wall_s", step.get("busy_s", 0))):
+            if "wall_s" in step:
+                parts = [f"{step['name']}: {step['wall_s']:.2f} s"]
+            else:
+                parts = [f"{step['name']}: {step.get('busy_s', 0):.2f} s busy"]
+            if "cpu_s" in step:
+                parts.append(f"CPU {step['cpu_s']:.2f} s")
+            if step.get("peak_rss_mb") is not None:
+                parts.append(f"peak {step['peak_rss_mb']:.0f} MB")
+            if "read_bytes" in step:
+                parts.append(f"read {step['read_bytes'] / (1 << 20):.1f} MB, written {step['written_bytes'] / (1 << 20):.1f} MB")
+            if step.get("pixels"):
+                parts.append(f"{step['pixels']} pixels")
+            lines.append(", ".join(parts))
+        return lines
+
+
+#------------------------------------------------------Stage scheduler------------------------------------------------------
+
+class Stage:
+    """One step of the run: func(feedback, context, results) -> result.
+
+    The stage starts as soon as every stage named in depends has finished;
+    results holds the return values of the finished stages by name.
+    """
+
+    def __init__(self, name: str, func, depends: tuple = ()):
+        self.name = name
+        self.func = func
+        self.depends = tuple(depends)
+
+
+class StageFeedback(QgsProcessingFeedback):
+    """Feedback handed to a stage running on a worker thread.
+
+    Messages are forwarded to the parent feedback under a lock, progress is
+    reported through progressChanged and cancel() is driven by run_stages.
+    """
+
+    def __init__(self, name: str, parent: QgsProcessingFeedback, lock: threading.Lock):
+        super().__init__()
+        self.name = name
+        self.parent = parent
+        self.lock = lock
+
+    def pushInfo(self, info):
+        with self.lock:
+            self.parent.pushInfo(info)
+
+    def pushWarning(self, warning):
+        with self.lock:
+            self.parent.pushWarning(warning)
+
+    def pushDebugInfo(self, info):
+        with self.lock:
+            self.parent.pushDebugInfo(info)
+
+    def reportError(self, error, fatalError=False):
+        with self.lock:
+            self.parent.reportError(f"[{self.name}] {error}", fatalError)
+
+
+def _run_stage(
+    stage: Stage,
+    feedback: StageFeedback,
+    context: QgsProcessingContext,
+    results: dict,
+    report: Optional[RunReport] = None,
+):
+    # A processing context belongs to the thread that created it, so every
+    # stage gets its own copy of the parent's thread safe settings.
+    stage_context = QgsProcessingContext()
+    stage_context.copyThreadSafeSettings(context)
+    if feedback.isCanceled():
+        return None
+    if report is None:
+        return stage.func(feedback, stage_context, results)
+    with report.measure(stage.name):
+        return stage.func(feedback, stage_context, results)
+
+
+def run_stages(
+    stages: list[Stage],
+    feedback: QgsProcessingFeedback,
+    context: QgsProcessingContext,
+    max_workers: Optional[int] = None,
+    report: Optional[RunReport] = None,
+) -> dict[str, Any]:
+    """Run stages on a thread pool, honouring their dependencies.
+
+    GDAL and NumPy release the GIL, so independent stages overlap and the
+    wall time tends to that of the longest chain. Progress is the mean of
+    the stage progresses; cancelling feedback cancels every running stage.
+    The first stage error cancels the rest and is raised again here. Every
+    stage is measured into report when given.
+    """
+    names = {stage.name for stage in stages}
+    for stage in stages:
+        missing = set(stage.depends) - names
+        if missing:
+            raise QgsProcessingException(f"Stage {stage.name} depends on unknown stages {sorted(missing)}")
+    max_workers = max(1, min(max_workers or os.cpu_count() or 1, len(stages)))
+
+    lock = threading.Lock()
+    progress = {stage.name: 0.0 for stage in stages}
+    pending = {stage.name: stage for stage in stages}
+    running = {}
+    results = {}
+    error = None
+
+    def set_progress(name, value):
+        with lock:
+            progress[name] = value
+            total = sum(progress.values()) / len(progress)
+            feedback.setProgress(total)
+
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        while (pending or running) and error is None:
+            if not feedback.isCanceled():
+                for name, stage in list(pending.items()):
+                    if all(dep in results for dep in stage.depends):
+                        child = StageFeedback(name, feedback, lock)
+                        child.progressChanged.connect(partial(set_progress, name))
+                        future = pool.submit(_run_stage, stage, child, context, results, report)
+                        running[future] = (name, child)
+                        del pending[name]
+                if not running:
+                    raise QgsProcessingException(f"Circular stage dependencies between {sorted(pending)}")
+            elif not running:
+                break
+
+            done, _ = wait(list(running), timeout=0.2, return_when=FIRST_COMPLETED)
+            if feedback.isCanceled():
+                for _, child in running.values():
+                    child.cancel()
+            for future in done:
+                name, child = running.pop(future)
+                try:
+                    results[name] = future.result()
+                except Exception as e:
+                    error = e
+                    break
+                set_progress(name, 100.0)
+
+        if error is not None:
+            for _, child in running.values():
+                child.cancel()
+
+    if error is not None:
+        raise error
+    return results
+
 
 class ExampleProcessingAlgorithm(QgsProcessingAlgorithm):
    
@@ -71,7 +2539,7 @@ class ExampleProcessingAlgorithm(QgsProcessingAlgorithm):
     
      Instructions for CSV Preparation:
     1. Ensure that you have CSV files corresponding to the shapefiles you are using.
-    2. Each CSV file should contain two columns: "IN_" and "OUT".
+    2. Each CSV file should contain two columns: "IN_" and "OUT", separated by ";" or ",".
     3. The "IN_" column should contain the values from the shapefile attribute you want to reclassify.
     4. The "OUT" column should contain the new values you want to assign to the corresponding "IN_" values.
     5. Save the CSV files with a clear name indicating their purpose (e.g., reclass_geology.csv, reclass_soil.csv).
@@ -82,6 +2550,54 @@ class ExampleProcessingAlgorithm(QgsProcessingAlgorithm):
     Value1,NewValue1
     Value2,NewValue2
     Value3,NewValue3
+
+    Weights:
+    The weights default to the standard DRASTIC ones (D 5, R 4, A 3, S 2, T 1, I 5).
+    For pesticide DRASTIC use D 5, R 4, A 3, S 5, T 3, I 4.
+    To compare several weightings in one run, give a scenario CSV with one row per
+    weight set and the columns D, R, A, S, T, I (optional C and NAME); the DRASTIC
+    weight scenarios output then gets one band per row.
+
+    Depth to water:
+    Repeated readings can be reduced to one point per well (median, latest or mean
+    over a date window) before interpolating. With cross-validation, every candidate
+    IDW power and number of nearest wells is scored by leave-one-out RMSE and MAE,
+    the best one is used and the scores are saved as idw_cross_validation.csv in
+    the output folder.
+
+    Vulnerability classes:
+    The index is classified while it is computed, with the class breaks given
+    (by default very low < 80, low < 120, moderate < 160, high < 200, very high).
+    The exact histogram of the index and the area of each class are always saved
+    as drastic_histogram.csv and drastic_class_areas.csv in the output folder;
+    the class raster itself is optional.
+
+    Epochs:
+    To follow the index over years or seasons, give the rainfall rasters and/or
+    the well layers of every epoch, in order (a missing series keeps the single
+    layer for every epoch). Geology, soil and topography are rated once; only D
+    and R are computed per epoch, in the same pass as the index. Every epoch is
+    a band of the DRASTIC of each epoch output, the change between consecutive
+    epochs can be written too, and drastic_epochs.csv in the output folder sums
+    up each epoch.
+
+    Factor stack:
+    The ratings of every factor can be kept as a factor stack: a folder with the
+    grid, weights and constant in factor_stack.json and the ratings in a chunked
+    ratings.npy that is memory-mapped when opened, so later re-weighting,
+    statistics or point queries only read the chunks they need. DRASTIC_query.py
+    gives the index and factor ratings at many points from a stack.
+
+    Zones:
+    Give a polygon layer of zones (municipalities, parcels, wellhead protection
+    zones...) to get, for each of them, the pixel count, mean, minimum and maximum
+    index and the area of each vulnerability class, computed in the same pass as
+    the index.
+
+    Output format:
+    The DRASTIC rasters are written as tiled GeoTIFFs compressed with a predictor,
+    with overviews, by default. A Cloud Optimized GeoTIFF suits web viewers and
+    range reads; extra GDAL creation options can be given as KEY=VALUE|KEY=VALUE.
     
     
     
@@ -105,6 +2621,113 @@ class ExampleProcessingAlgorithm(QgsProcessingAlgorithm):
                 type=QgsProcessingParameterField.Numeric  # restringe a campos numéricos
             )
         )
+        self.addParameter(
+            QgsProcessingParameterEnum(
+                name='idw_motor',
+                description='IDW interpolation engine for the letter D',
+                options=['Built-in (KD-tree, block-wise)', 'QGIS IDW interpolation'],
+                defaultValue=0
+            )
+        )
+        self.addParameter(
+            QgsProcessingParameterNumber(
+                name='idw_potencia',
+                description='IDW distance coefficient (power)',
+                type=QgsProcessingParameterNumber.Double,
+                minValue=0,
+                defaultValue=2
+            )
+        )
+        self.addParameter(
+            QgsProcessingParameterNumber(
+                name='idw_vizinhos',
+                description='IDW number of nearest wells used per pixel (0 = all wells, built-in engine only)',
+                type=QgsProcessingParameterNumber.Integer,
+                minValue=0,
+                defaultValue=0
+            )
+        )
+        self.addParameter(
+            QgsProcessingParameterNumber(
+                name='idw_raio',
+                description='IDW search radius in map units (0 = unlimited, built-in engine only)',
+                type=QgsProcessingParameterNumber.Double,
+                minValue=0,
+                defaultValue=0
+            )
+        )
+        self.addParameter(
+            QgsProcessingParameterBoolean(
+                name='idw_validacao',
+                description='Choose the IDW power and neighbours by leave-one-out cross-validation',
+                defaultValue=False
+            )
+        )
+        idw_potencias = QgsProcessingParameterString(
+            name='idw_potencias',
+            description='Candidate IDW powers for cross-validation',
+            defaultValue='1, 1.5, 2, 2.5, 3, 4'
+        )
+        idw_potencias.setFlags(idw_potencias.flags() | QgsProcessingParameterDefinition.FlagAdvanced)
+        self.addParameter(idw_potencias)
+        idw_vizinhos_cv = QgsProcessingParameterString(
+            name='idw_vizinhos_cv',
+            description='Candidate numbers of nearest wells for cross-validation (0 = all wells)',
+            defaultValue='0, 4, 8, 12, 16, 24, 32'
+        )
+        idw_vizinhos_cv.setFlags(idw_vizinhos_cv.flags() | QgsProcessingParameterDefinition.FlagAdvanced)
+        self.addParameter(idw_vizinhos_cv)
+        self.addParameter(
+            QgsProcessingParameterEnum(
+                name='agregacao_pocos',
+                description='Observations per well used for D (built-in engine only)',
+                options=list(WELL_AGGREGATIONS),
+                defaultValue=0
+            )
+        )
+        self.addParameter(
+            QgsProcessingParameterField(
+                name='coluna_poco',
+                description='Column identifying the well of each observation (empty = same position, same well)',
+                parentLayerParameterName='caminho_points',
+                optional=True
+            )
+        )
+        self.addParameter(
+            QgsProcessingParameterField(
+                name='coluna_data',
+                description='Column with the date of each observation',
+                parentLayerParameterName='caminho_points',
+                optional=True
+            )
+        )
+        for nome, descricao in (('data_inicio', 'Use observations from this date'), ('data_fim', 'Use observations up to this date')):
+            self.addParameter(
+                QgsProcessingParameterDateTime(
+                    name=nome,
+                    description=descricao,
+                    type=QgsProcessingParameterDateTime.Date,
+                    optional=True
+                )
+            )
+        distancia_pocos = QgsProcessingParameterNumber(
+            name='distancia_pocos',
+            description='Merge wells closer than this distance in map units (0 = keep all)',
+            type=QgsProcessingParameterNumber.Double,
+            minValue=0,
+            defaultValue=0
+        )
+        distancia_pocos.setFlags(distancia_pocos.flags() | QgsProcessingParameterDefinition.FlagAdvanced)
+        self.addParameter(distancia_pocos)
+        margem_pocos = QgsProcessingParameterNumber(
+            name='margem_pocos',
+            description='Only use wells within this distance of the extent (-1 = all wells)',
+            type=QgsProcessingParameterNumber.Double,
+            minValue=-1,
+            defaultValue=-1
+        )
+        margem_pocos.setFlags(margem_pocos.flags() | QgsProcessingParameterDefinition.FlagAdvanced)
+        self.addParameter(margem_pocos)
 
         
         #geologia
@@ -190,6 +2813,42 @@ class ExampleProcessingAlgorithm(QgsProcessingAlgorithm):
                 type=QgsProcessingParameterField.Any
             )
         )
+        #Pesos
+        for factor, descricao in (
+            ('D', 'Depth to water'),
+            ('R', 'net Recharge'),
+            ('A', 'Aquifer media'),
+            ('S', 'Soil media'),
+            ('T', 'Topography'),
+            ('I', 'Impact of the vadose zone'),
+        ):
+            self.addParameter(
+                QgsProcessingParameterNumber(
+                    name=f'peso_{factor.lower()}',
+                    description=f'Weight of the letter {factor} ({descricao})',
+                    type=QgsProcessingParameterNumber.Double,
+                    minValue=0,
+                    defaultValue=DRASTIC_WEIGHTS[factor]
+                )
+            )
+        self.addParameter(
+            QgsProcessingParameterNumber(
+                name='constante_c',
+                description='Constant added to the index (hydraulic Conductivity term)',
+                type=QgsProcessingParameterNumber.Double,
+                defaultValue=DRASTIC_CONSTANT
+            )
+        )
+        self.addParameter(
+            QgsProcessingParameterFile(
+                name='cenarios_csv',
+                description='CSV file with weight scenarios (columns D, R, A, S, T, I and optional C, NAME)',
+                behavior=QgsProcessingParameterFile.File,
+                fileFilter='CSV files (*.csv)',
+                optional=True
+            )
+        )
+
         self.addParameter(
             QgsProcessingParameterExtent(
                 name='extensao',
@@ -197,9 +2856,84 @@ class ExampleProcessingAlgorithm(QgsProcessingAlgorithm):
                 defaultValue=None  # ou define uma extensão inicial
             )
         )
+        self.addParameter(
+            QgsProcessingParameterNumber(
+                name='tamanho_pixel',
+                description='Pixel size of the output grid (in units of the output CRS)',
+                type=QgsProcessingParameterNumber.Double,
+                minValue=0.000001,
+                defaultValue=25
+            )
+        )
+        self.addParameter(
+            QgsProcessingParameterCrs(
+                name='sistema_coordenadas',
+                description='CRS of the output grid (all inputs are reprojected on the fly)',
+                defaultValue='EPSG:3763'
+            )
+        )
 
 #--------Outputs
 
+        n_threads = QgsProcessingParameterNumber(
+            name='n_threads',
+            description='Number of threads for the factors and the blocks of the index (0 = one per CPU core)',
+            type=QgsProcessingParameterNumber.Integer,
+            minValue=0,
+            defaultValue=0
+        )
+        n_threads.setFlags(n_threads.flags() | QgsProcessingParameterDefinition.FlagAdvanced)
+        self.addParameter(n_threads)
+
+        tamanho_tile = QgsProcessingParameterNumber(
+            name='tamanho_tile',
+            description=f'Size in pixels of the blocks the index is computed in (0 = {BLOCK_SIZE})',
+            type=QgsProcessingParameterNumber.Integer,
+            minValue=0,
+            defaultValue=0
+        )
+        tamanho_tile.setFlags(tamanho_tile.flags() | QgsProcessingParameterDefinition.FlagAdvanced)
+        self.addParameter(tamanho_tile)
+
+        self.addParameter(
+            QgsProcessingParameterNumber(
+                name='cache_mb',
+                description='Size in MB of the factor cache kept in the output folder (0 = no cache)',
+                type=QgsProcessingParameterNumber.Integer,
+                minValue=0,
+                defaultValue=0
+            )
+        )
+        self.addParameter(
+            QgsProcessingParameterBoolean(
+                name='manter_intermedios',
+                description='Keep intermediate rasters (idw and the factor rasters) in the output folder',
+                defaultValue=False
+            )
+        )
+        intermedios_memoria = QgsProcessingParameterBoolean(
+            name='intermedios_memoria',
+            description='Hold intermediates that are not kept in memory (GDAL /vsimem) instead of temporary files',
+            defaultValue=False
+        )
+        intermedios_memoria.setFlags(intermedios_memoria.flags() | QgsProcessingParameterDefinition.FlagAdvanced)
+        self.addParameter(intermedios_memoria)
+        self.addParameter(
+            QgsProcessingParameterEnum(
+                name='formato_saida',
+                description='Format of the DRASTIC rasters (index, scenarios and effective weights)',
+                options=list(OUTPUT_FORMATS),
+                defaultValue=0
+            )
+        )
+        opcoes_criacao = QgsProcessingParameterString(
+            name='opcoes_criacao',
+            description='GDAL creation options of the output format (KEY=VALUE separated by |, e.g. COMPRESS=ZSTD|LEVEL=9)',
+            defaultValue='',
+            optional=True
+        )
+        opcoes_criacao.setFlags(opcoes_criacao.flags() | QgsProcessingParameterDefinition.FlagAdvanced)
+        self.addParameter(opcoes_criacao)
         self.addParameter(
             QgsProcessingParameterFolderDestination(
                 name='pasta',
@@ -212,6 +2946,116 @@ class ExampleProcessingAlgorithm(QgsProcessingAlgorithm):
                         'DRASTIC'
                     )
                 )
+        self.addParameter(
+            QgsProcessingParameterBoolean(
+                name='sensibilidade',
+                description='Run the map removal and single-parameter sensitivity analyses (tables in the output folder)',
+                defaultValue=False
+            )
+        )
+        self.addParameter(
+            QgsProcessingParameterRasterDestination(
+                'pesos_efetivos',
+                'Effective weight of each factor per pixel (sensitivity analysis)',
+                optional=True,
+                createByDefault=False
+            )
+        )
+        self.addParameter(
+            QgsProcessingParameterRasterDestination(
+                'drastic_cenarios',
+                'DRASTIC weight scenarios (one band per scenario)',
+                optional=True,
+                createByDefault=False
+            )
+        )
+        self.addParameter(
+            QgsProcessingParameterString(
+                name='limites_classes',
+                description='Vulnerability class breaks of the index (class map, class areas and zone statistics)',
+                defaultValue=', '.join(str(limite) for limite in VULNERABILITY_BREAKS)
+            )
+        )
+        nomes_classes = QgsProcessingParameterString(
+            name='nomes_classes',
+            description='Names of the vulnerability classes, comma separated (one more than the breaks)',
+            defaultValue='',
+            optional=True
+        )
+        nomes_classes.setFlags(nomes_classes.flags() | QgsProcessingParameterDefinition.FlagAdvanced)
+        self.addParameter(nomes_classes)
+        self.addParameter(
+            QgsProcessingParameterRasterDestination(
+                'classes_drastic',
+                'DRASTIC vulnerability classes',
+                optional=True,
+                createByDefault=False
+            )
+        )
+        self.addParameter(
+            QgsProcessingParameterFolderDestination(
+                'pilha_factores',
+                'Factor stack (memory-mapped ratings of every factor, for later reuse)',
+                optional=True,
+                createByDefault=False
+            )
+        )
+        self.addParameter(
+            QgsProcessingParameterMultipleLayers(
+                'series_prec',
+                'Rainfall rasters of each epoch (multi-epoch mode, in order)',
+                QgsProcessing.SourceType.TypeRaster,
+                optional=True
+            )
+        )
+        self.addParameter(
+            QgsProcessingParameterMultipleLayers(
+                'series_points',
+                'Well observations of each epoch (multi-epoch mode, in order)',
+                QgsProcessing.SourceType.TypeVectorPoint,
+                optional=True
+            )
+        )
+        nomes_epocas = QgsProcessingParameterString(
+            name='nomes_epocas',
+            description='Names of the epochs, comma separated (default: the layer names)',
+            defaultValue='',
+            optional=True
+        )
+        nomes_epocas.setFlags(nomes_epocas.flags() | QgsProcessingParameterDefinition.FlagAdvanced)
+        self.addParameter(nomes_epocas)
+        self.addParameter(
+            QgsProcessingParameterRasterDestination(
+                'drastic_epocas',
+                'DRASTIC of each epoch (one band per epoch)',
+                optional=True,
+                createByDefault=False
+            )
+        )
+        self.addParameter(
+            QgsProcessingParameterRasterDestination(
+                'mudanca_epocas',
+                'DRASTIC change between consecutive epochs',
+                optional=True,
+                createByDefault=False
+            )
+        )
+        self.addParameter(
+            QgsProcessingParameterFeatureSource(
+                'zonas',
+                'Zones for statistics (municipalities, parcels, protection zones...)',
+                [QgsProcessing.SourceType.TypeVectorPolygon],
+                optional=True
+            )
+        )
+        self.addParameter(
+            QgsProcessingParameterFeatureSink(
+                'estatisticas_zonas',
+                'DRASTIC statistics per zone',
+                QgsProcessing.SourceType.TypeVectorPolygon,
+                optional=True
+            )
+        )
 
 
 
@@ -224,6 +3068,7 @@ class ExampleProcessingAlgorithm(QgsProcessingAlgorithm):
         """
         Here is where the processing itself takes place.
         """
+        relatorio = RunReport()
 
         # # Retrieve the feature source and sink. The 'dest_id' variable is used
         # # to uniquely identify the feature sink, and must be included in the
@@ -233,6 +3078,27 @@ class ExampleProcessingAlgorithm(QgsProcessingAlgorithm):
         caminho_points=points.source()
         coluna_points = self.parameterAsString(parameters, 'coluna_points', context)
         index = points.fields().indexOf(coluna_points)
+        fonte_pontos = self.parameterAsSource(parameters, 'caminho_points', context)
+        idw_motor = self.parameterAsEnum(parameters, 'idw_motor', context)
+        idw_potencia = self.parameterAsDouble(parameters, 'idw_potencia', context)
+        idw_vizinhos = self.parameterAsInt(parameters, 'idw_vizinhos', context)
+        idw_raio = self.parameterAsDouble(parameters, 'idw_raio', context)
+        validacao = self.parameterAsBoolean(parameters, 'idw_validacao', context)
+        potencias_cv, vizinhos_cv = [], []
+        if validacao:
+            potencias_cv = _parse_candidates(self.parameterAsString(parameters, 'idw_potencias', context))
+            vizinhos_cv = _parse_candidates(self.parameterAsString(parameters, 'idw_vizinhos_cv', context), int)
+        if validacao and not (potencias_cv and vizinhos_cv):
+            raise QgsProcessingException("Cross-validation needs at least one candidate power and neighbour count")
+        agregacao_pocos = self.parameterAsEnum(parameters, 'agregacao_pocos', context)
+        coluna_poco = self.parameterAsString(parameters, 'coluna_poco', context)
+        coluna_data = self.parameterAsString(parameters, 'coluna_data', context)
+        janela_datas = tuple(
+            data.date().toPyDate().toordinal() if data.isValid() else None
+            for data in (self.parameterAsDateTime(parameters, nome, context) for nome in ('data_inicio', 'data_fim'))
+        )
+        distancia_pocos = self.parameterAsDouble(parameters, 'distancia_pocos', context)
+        margem_pocos = self.parameterAsDouble(parameters, 'margem_pocos', context)
         geologia = self.parameterAsVectorLayer(parameters, 'caminho_geologia', context)
         caminho_geologia=geologia.source()
         soil = self.parameterAsVectorLayer(parameters, 'caminho_soil', context)
@@ -247,590 +3113,510 @@ class ExampleProcessingAlgorithm(QgsProcessingAlgorithm):
         coluna_recli = self.parameterAsString(parameters, 'coluna_recli', context)
         caminho_recli_csv = self.parameterAsFile(parameters, 'caminho_recli_csv', context)
         caminho_recla_csv = self.parameterAsFile(parameters, 'caminho_recla_csv', context)
-        extent = self.parameterAsExtent(parameters, 'extensao', context)
-        xmin = extent.xMinimum()
-        xmax = extent.xMaximum()
-        ymin = extent.yMinimum()
-        ymax = extent.yMaximum()
-        # Se precisares de usar como string:
-        extensao = f"{xmin},{ymin},{xmax},{ymax} [EPSG:3763]"
-        
-        pixel = 25
+        # Every factor is computed on this one grid; the extent is taken in
+        # the output CRS whatever CRS it was drawn in.
+        destino_crs = self.parameterAsCrs(parameters, 'sistema_coordenadas', context)
+        if not destino_crs.isValid():
+            raise QgsProcessingException("Invalid output CRS")
+        extent = self.parameterAsExtent(parameters, 'extensao', context, destino_crs)
+        if extent.isEmpty():
+            raise QgsProcessingException("The processing extent is empty")
+        grelha = TargetGrid(
+            (extent.xMinimum(), extent.yMinimum(), extent.xMaximum(), extent.yMaximum()),
+            self.parameterAsDouble(parameters, 'tamanho_pixel', context),
+            destino_crs.authid() or destino_crs.toWkt(),
+        )
         pasta = self.parameterAsString(parameters, 'pasta', context)
-        if feedback.isCanceled():
-            return {}
-
-        feedback.pushInfo("Começou")
-        #------------------------------------------------------D------------------------------------------------------
-        #------------------interpolação------------------
-
-        idw_raster=processing.run(
-            "qgis:idwinterpolation",
-            {
-                'INTERPOLATION_DATA': f"{caminho_points}::~::0::~::{index}::~::0",
-                'DISTANCE_COEFFICIENT': 2,
-                'EXTENT': extensao,
-                'PIXEL_SIZE': pixel,
-                'OUTPUT': f'{pasta}/idw.tif'
-            },
-            is_child_algorithm = True,
-            context=context,
-            feedback=feedback
+        caminho_validacao = os.path.join(pasta, 'idw_cross_validation.csv')
+        manter_intermedios = self.parameterAsBoolean(parameters, 'manter_intermedios', context)
+
+        def intermedio(nome):
+            # Intermediates only land in pasta when the user asks to keep them
+            return f'{pasta}/{nome}' if manter_intermedios else QgsProcessing.TEMPORARY_OUTPUT
+
+        n_threads = self.parameterAsInt(parameters, 'n_threads', context) or None
+        pesos = {f: self.parameterAsDouble(parameters, f'peso_{f.lower()}', context) for f in FACTORS}
+        constante_c = self.parameterAsDouble(parameters, 'constante_c', context)
+        caminho_cenarios = self.parameterAsFile(parameters, 'cenarios_csv', context)
+        cenarios = read_weight_scenarios(caminho_cenarios) if caminho_cenarios else []
+        saida_cenarios = None
+        if cenarios:
+            saida_cenarios = self.parameterAsOutputLayer(parameters, 'drastic_cenarios', context) or os.path.join(pasta, 'drastic_scenarios.tif')
+        sensibilidade = self.parameterAsBoolean(parameters, 'sensibilidade', context)
+        saida_pesos_efetivos = self.parameterAsOutputLayer(parameters, 'pesos_efetivos', context) if sensibilidade else None
+        zonas = self.parameterAsSource(parameters, 'zonas', context)
+        limites_classes = parse_class_breaks(self.parameterAsString(parameters, 'limites_classes', context))
+        nomes_classes = [nome.strip() for nome in self.parameterAsString(parameters, 'nomes_classes', context).split(',') if nome.strip()]
+        saida_classes = self.parameterAsOutputLayer(parameters, 'classes_drastic', context) or None
+        saida_pilha = self.parameterAsFileOutput(parameters, 'pilha_factores', context) or None
+        # Multi-epoch mode: a missing series keeps the single layer for every epoch
+        series_prec = self.parameterAsLayerList(parameters, 'series_prec', context)
+        series_pontos = self.parameterAsLayerList(parameters, 'series_points', context)
+        if series_prec and series_pontos and len(series_prec) != len(series_pontos):
+            raise QgsProcessingException(
+                f"The rainfall series has {len(series_prec)} epochs and the well series {len(series_pontos)}"
+            )
+        n_epocas = max(len(series_prec), len(series_pontos))
+        chuvas_epocas = series_prec or [prec] * n_epocas
+        pocos_epocas = series_pontos or [points] * n_epocas
+        nomes_epocas = [nome.strip() for nome in self.parameterAsString(parameters, 'nomes_epocas', context).split(',') if nome.strip()]
+        if nomes_epocas and len(nomes_epocas) != n_epocas:
+            raise QgsProcessingException(f"{len(nomes_epocas)} epoch names given for {n_epocas} epochs")
+        nomes_epocas = nomes_epocas or [camada.name() for camada in (series_prec or series_pontos)]
+        saida_epocas = None
+        saida_mudanca = None
+        if n_epocas:
+            saida_epocas = self.parameterAsOutputLayer(parameters, 'drastic_epocas', context) or os.path.join(pasta, 'drastic_epochs.tif')
+            saida_mudanca = self.parameterAsOutputLayer(parameters, 'mudanca_epocas', context) or None
+        cache_mb = self.parameterAsInt(parameters, 'cache_mb', context)
+        tamanho_tile = self.parameterAsInt(parameters, 'tamanho_tile', context)
+        formato = RasterFormat(
+            self.parameterAsEnum(parameters, 'formato_saida', context),
+            parse_creation_options(self.parameterAsString(parameters, 'opcoes_criacao', context)),
         )
-        if feedback.isCanceled():
-            return {}
-        
-
-        idw=QgsRasterLayer(idw_raster['OUTPUT'],"IDW")
 
-        feedback.pushInfo("Acabou IDW")
+        # Intermediates written by GDAL itself can live in memory; the ones
+        # written by child algorithms still need a real file name.
+        memoria = None
+        if not manter_intermedios and self.parameterAsBoolean(parameters, 'intermedios_memoria', context):
+            memoria = MemoryFolder()
 
-        #------------------csv to shp.------------------
-
-        expressaod = (
-            '("idw@1" >= 0 AND "idw@1" < 1.524) * 10 + '
-            '("idw@1" >= 1.524 AND "idw@1" < 4.572) * 9 + '
-            '("idw@1" >= 4.572 AND "idw@1" < 9.144) * 7 + '
-            '("idw@1" >= 9.144 AND "idw@1" < 15.24) * 5 + '
-            '("idw@1" >= 15.24 AND "idw@1" < 22.86) * 3 + '
-            '("idw@1" >= 22.86 AND "idw@1" < 30.48) * 2 + '
-            '("idw@1" >= 30.48 AND "idw@1" < 99999) * 1 + '
-            '("idw@1" < 0 OR "idw@1" >= 99999) * "idw@1"'
-        )
-        #Configurar as entradas para o raster calculator
+        def temporario(nome):
+            if manter_intermedios:
+                return f'{pasta}/{nome}'
+            return memoria.file(nome) if memoria is not None else QgsProcessingUtils.generateTempFilename(nome)
 
+        if feedback.isCanceled():
+            return {}
 
-        qrce = QgsRasterCalculatorEntry()
-        qrce .bandNumber = 1
-        qrce. raster = idw
-        qrce.ref = 'idw@1'
+        feedback.pushInfo("Começou")
 
-        entradas = [qrce]
+        #------------------------------------------------------D------------------------------------------------------
 
+        def validar_idw(feedback, xy, valores, vizinhos_candidatos, etapa='D', caminho_cv=caminho_validacao):
+            # Power and neighbour count with the lowest leave-one-out RMSE
+            with relatorio.measure(f'{etapa} cross-validation', points=len(xy)) as passo:
+                resultados_cv = cross_validate_idw(xy, valores, potencias_cv, vizinhos_candidatos, idw_raio)
+                passo['candidates'] = len(resultados_cv)
+            with open(caminho_cv, 'w', newline='', encoding='utf-8') as csvfile:
+                escritor = csv.writer(csvfile, delimiter=';')
+                escritor.writerow(['power', 'neighbours', 'rmse', 'mae', 'points'])
+                for r in resultados_cv:
+                    escritor.writerow([r['power'], r['neighbours'], r['rmse'], r['mae'], r['points']])
+            melhor = resultados_cv[0]
+            feedback.pushInfo(
+                f"IDW cross-validation: power {melhor['power']:g}, neighbours {melhor['neighbours'] or 'all'} "
+                f"(RMSE {melhor['rmse']:.3f}, MAE {melhor['mae']:.3f} over {melhor['points']} wells)"
+            )
+            return melhor['power'], melhor['neighbours']
+
+        def estagio_d_de(fonte, caminho, indice, etapa='D', caminho_cv=caminho_validacao, ficheiro_idw='idw.tif'):
+            # D stage from one set of well observations; the epochs of a series
+            # each get their own
+            return partial(estagio_d, fonte, caminho, indice, etapa, caminho_cv, ficheiro_idw)
+
+        def estagio_d(fonte, caminho, indice, etapa, caminho_cv, ficheiro_idw, feedback, context, resultados):
+            #------------------interpolação------------------
+            potencia, vizinhos = idw_potencia, idw_vizinhos
+
+            if idw_motor == 0:
+                # Interpolated block by block inside the overlay, no idw.tif
+                limites = None
+                if margem_pocos >= 0:
+                    xmin, ymin, xmax, ymax = grelha.bounds
+                    limites = (xmin - margem_pocos, ymin - margem_pocos, xmax + margem_pocos, ymax + margem_pocos)
+                with relatorio.measure(f'{etapa} load wells') as passo:
+                    xy, valores = load_points(
+                        fonte,
+                        coluna_points,
+                        destino_crs,
+                        context.transformContext(),
+                        feedback,
+                        well_field=coluna_poco,
+                        date_field=coluna_data,
+                        date_window=janela_datas,
+                        bounds=limites,
+                        aggregate=agregacao_pocos,
+                        thin=distancia_pocos,
+                    )
+                    passo['points'] = len(xy)
+                if not len(xy):
+                    raise QgsProcessingException(f"No well observation left for {etapa} after filtering")
+                if feedback.isCanceled():
+                    return None
+                if validacao:
+                    potencia, vizinhos = validar_idw(feedback, xy, valores, vizinhos_cv, etapa, caminho_cv)
+                if cKDTree is None and (vizinhos or idw_raio):
+                    feedback.pushWarning("scipy is not available, nearest wells are searched by brute force")
+                with relatorio.measure(f'{etapa} IDW index', points=len(xy)):
+                    interpolador = IdwInterpolator(xy, valores, potencia, vizinhos, idw_raio)
+                feedback.pushInfo(f"IDW over {len(xy)} points")
+                feedback.pushInfo(f"acabou {etapa}")
+                return IdwRatingSource(
+                    grelha.dataset,
+                    interpolador,
+                    rate_by_breaks(D_BREAKS, D_RATINGS),
+                )
 
-        #Criar o objeto QgsRasterCalculator
-        reclassifyd = QgsRasterCalculator(expressaod, f"{pasta}/d.tif", "GTiff",idw.extent(), idw.width(), idw.height(), entradas)
+            if validacao:
+                # The QGIS engine always uses every well, so only the power is chosen
+                xy, valores = load_points(fonte, coluna_points, destino_crs, context.transformContext(), feedback)
+                potencia, _ = validar_idw(feedback, xy, valores, [0], etapa, caminho_cv)
+            if idw_vizinhos or idw_raio:
+                feedback.pushWarning("The QGIS IDW interpolation always uses every well; neighbours and radius are ignored")
+            if agregacao_pocos or distancia_pocos or margem_pocos >= 0 or any(d is not None for d in janela_datas):
+                feedback.pushWarning("The QGIS IDW interpolation uses every observation; well filtering and aggregation are ignored")
+            with relatorio.measure(f'{etapa} QGIS IDW', pixels=grelha.cols * grelha.rows):
+                idw_raster=processing.run(
+                    "qgis:idwinterpolation",
+                    {
+                        'INTERPOLATION_DATA': f"{caminho}::~::0::~::{indice}::~::0",
+                        'DISTANCE_COEFFICIENT': potencia,
+                        'EXTENT': grelha.extent_string(),
+                        'PIXEL_SIZE': grelha.pixel,
+                        'OUTPUT': intermedio(ficheiro_idw)
+                    },
+                    is_child_algorithm = True,
+                    context=context,
+                    feedback=feedback
+                )
+            if feedback.isCanceled():
+                return None
+        
 
-        #Executar o cálculo
-        reclassifyd.processCalculation()
+            feedback.pushInfo("Acabou IDW")
 
-        reclassifyd_layer=QgsRasterLayer(f"{pasta}/d.tif","d")
+            #------------------reclassificação------------------
 
-        feedback.setProgress(13)
-        feedback.pushInfo("acabou D")
+            feedback.pushInfo(f"acabou {etapa}")
+            return RatingSource(
+                grelha.opener(idw_raster['OUTPUT']),
+                rate_by_breaks(D_BREAKS, D_RATINGS),
+            )
 
         #------------------------------------------------------R------------------------------------------------------
 
-        #------------------Reclassificação------------------
-
-        # Carregar a camada raster inicial
-        #crs_res = QgsCoordinateReferenceSystem(“EPSG:3763”)
-        prec = QgsRasterLayer(caminho_prec, "prec",)
-
-        #QgsProject.instance().addMapLayer(prec)
-
-
-        # Criar a expressão para o raster calculator Aqui, estamos reclassificando os valores entre valor_inicial e valor_final para valor_reclassificado
-        expressaor = (
-            '("prec@1" >= 0 AND "prec@1" < 50.8) * 1 + '
-            '("prec@1" >= 50.8 AND "prec@1" < 101.6) * 3 + '
-            '("prec@1" >= 101.6 AND "prec@1" < 177.8) * 6 + '
-            '("prec@1" >= 177.8 AND "prec@1" < 254) * 8 + '
-            '("prec@1" >= 254 AND "prec@1" < 99999) * 9 + '
-            '("prec@1" < 0 OR "prec@1" >= 99999) * "prec@1"'
-        )
-        #Configurar as entradas para o raster calculator
-        #entradas = [QgsRasterCalculatorEntry(prec, 1, 'prec@1')]
-
-        qrce = QgsRasterCalculatorEntry()
-        qrce .bandNumber = 1
-        qrce. raster = prec
-        qrce.ref = 'prec@1'
+        def estagio_r_de(caminho):
+            def estagio_r(feedback, context, resultados):
 
-        entradas = [qrce]
+                #------------------Reclassificação------------------
 
-
-        #Criar o objeto QgsRasterCalculator
-        reclassifyr = QgsRasterCalculator(expressaor, f"{pasta}/r.tif", "GTiff", prec.extent(), prec.width(), prec.height(), entradas)
-
-        #Executar o cálculo
-        reclassifyr.processCalculation()
-
-        feedback.setProgress(25)
-        feedback.pushInfo("acabou R")
+                feedback.pushInfo("acabou R")
+                return RatingSource(
+                    grelha.opener(caminho),
+                    rate_by_breaks(R_BREAKS, R_RATINGS),
+                )
+            return estagio_r
 
         #------------------------------------------------------A------------------------------------------------------
 
-        #------------------gopakage to shp.------------------
-        #geologia = QgsVectorLayer(f"{caminho_geologia}|layername={camada_geologia}", "geologia", "ogr")
-        geologia = QgsVectorLayer(f"{caminho_geologia}", "geologia", "ogr")
-
-        #------------------reclassificação------------------
-
-        #------------------shp add values------------------
-
-        #------------------call csv------------------
-        try:
-            # Open the CSV file
-            with open(caminho_recla_csv, newline='', encoding='utf-8-sig') as csvfile:
-                # Create a CSV reader object
-                reader = csv.reader(csvfile)
-                
-            # Read the headers and split them
-                headers = next(reader)
-                headers = [header.strip() for header in headers[0].split(';')]
-
-                for i, row in enumerate(reader):
-                    if i < 5:  # Print only the first 5 rows
-                        row_dict = dict(zip(headers, row[0].split(';')))
-                        #print(row_dict)
-                    else:
-                        break
-
-        except FileNotFoundError:
-            feedback.pushInfo(f"Error: The file at {csv_path} was not found.")
-        except Exception as e:
-            feedback.pushInfo(f"An error occurred: {e}")
-
-        in_out_map = {}#este dicionário é o csv transformado para visualizar faz print(in_out_map) antes de except
-        try:
-            # Open the CSV file again to create the mapping
-            with open(caminho_recla_csv, newline='', encoding='utf-8-sig') as csvfile:
-                reader = csv.reader(csvfile)
-
-                # Read the headers and split them
-                headers = next(reader)
-                headers = [header.strip() for header in headers[0].split(';')]
-
-                # Iterate over the rows and create the mapping
-                for row in reader:
-                    row_dict = dict(zip(headers, row[0].split(';')))
-                    in_value = row_dict["IN_"]
-                    out_value = row_dict["OUT"]
-                    in_out_map[in_value] = out_value
-
-
-
-        except Exception as e:
-            print(f"An error occurred while creating the mapping: {e}")
-
-        #------------------call .shp------------------
-
-        # Check if the layer is valid
-        if not geologia.isValid():
-            feedback.pushInfo("Failed to load the layer!")
-            # Print additional information about the error
-            feedback.pushInfo("Error details:", geologia.error().summary())
-            feedback.pushInfo("File readable:", os.access(caminho_geologia, os.R_OK))
-        else:
-            # Start editing the layer
-            geologia.startEditing()
-
-            # Add a new field to store the "OUT" values
-            new_field = QgsField("OUT", QVariant.Double)
-            geologia.dataProvider().addAttributes([new_field])
-            geologia.updateFields()
-
-            # Get the index of the new field
-            out_field_index = geologia.fields().indexFromName("OUT")
-
-            # Iterate over each feature in the layer
-            for feature in geologia.getFeatures():
-                classifica_value = feature[coluna_recla]
-                # Check if the "CLASSIFICA" value exists in the mapping
-                if classifica_value in in_out_map:
-                    out_value = in_out_map[classifica_value]
-                    # Update the new field with the "OUT" value
-                    geologia.dataProvider().changeAttributeValues({feature.id(): {out_field_index: out_value}})
-            geologia.commitChanges()
-
-
-        #------------------shp to raster------------------
-
-        reclassifya=processing.run("gdal:rasterize", {'INPUT':f'{caminho_geologia}','FIELD':'OUT','BURN':0,'USE_Z':False,'UNITS':1,'WIDTH':25,'HEIGHT':25,'EXTENT':extent,'NODATA':0,'OPTIONS':None,'DATA_TYPE':5,'INIT':None,'INVERT':False,'EXTRA':'','OUTPUT':f'{pasta}/a.tif'},is_child_algorithm = True,context=context,feedback=feedback)
-        if feedback.isCanceled():
-            return {}
-        
-        feedback.setProgress(38)
-        feedback.pushInfo('acabou A')
+        def estagio_a(feedback, context, resultados):
+            #------------------shp to raster------------------
+            with relatorio.measure('A rasterize', pixels=grelha.cols * grelha.rows) as passo:
+                caminho, chaves = rasterize_classes(caminho_geologia, [coluna_recla], grelha.dataset(), temporario('geologia_classes.tif'))
+                passo['classes'] = len(chaves)
+            if feedback.isCanceled():
+                return None
+
+            #------------------reclassificação------------------
+            with relatorio.measure('A reclass table'):
+                lut = class_lut(chaves, 0, load_reclass_table(caminho_recla_csv))
+            feedback.pushInfo('acabou A')
+            return RatingSource(partial(gdal.Open, caminho), rate_by_lookup(lut))
+
+        #------------------------------------------------------Solo------------------------------------------------------
+
+        # S and I come from two columns of the same soil layer: it is rasterized
+        # once over both columns and each factor is a lookup on those classes.
+        campos_solo = list(dict.fromkeys([coluna_recls, coluna_recli]))
+
+        def estagio_solo(feedback, context, resultados):
+            with relatorio.measure('SOLO rasterize', pixels=grelha.cols * grelha.rows) as passo:
+                caminho, chaves = rasterize_classes(caminho_soil, campos_solo, grelha.dataset(), temporario('solo_classes.tif'))
+                passo['classes'] = len(chaves)
+            return caminho, chaves
+
+        #------------------------------------------------------Zonas------------------------------------------------------
+
+        def estagio_zonas(feedback, context, resultados):
+            with relatorio.measure('ZONAS rasterize', pixels=grelha.cols * grelha.rows) as passo:
+                caminho, entidades = rasterize_zones(
+                    zonas, destino_crs, context.transformContext(), grelha.dataset(), temporario('zonas.tif'), feedback
+                )
+                passo['zones'] = len(entidades)
+            return caminho, entidades
 
         #------------------------------------------------------S------------------------------------------------------
-        #------------------shp------------------
-        soil = QgsVectorLayer(f"{caminho_soil}", "Soil", "ogr")
 
-        #------------------shp add values------------------
-
-        #------------------call csv------------------
-
-        try:
-            # Open the CSV file
-            with open(caminho_recls_csv, newline='', encoding='utf-8-sig') as csvfile:
-                # Create a CSV reader object
-                reader = csv.reader(csvfile)
-                
-            # Read the headers and split them
-                headers = next(reader)
-                headers = [header.strip() for header in headers[0].split(';')]
-
-                for i, row in enumerate(reader):
-                    if i < 5:  # Print only the first 5 rows
-                        row_dict = dict(zip(headers, row[0].split(';')))
-                        #print(row_dict)
-                    else:
-                        break
-
-        except FileNotFoundError:
-            feedback.pushInfo(f"Error: The file at {csv_path} was not found.")
-        except Exception as e:
-            feedback.pushInfo(f"An error occurred: {e}")
-
-
-        in_out_map = {} #este dicionário é o csv transformado para visualizar faz print(in_out_map) antes de except
-        try:
-            # Open the CSV file again to create the mapping
-            with open(caminho_recls_csv, newline='', encoding='utf-8-sig') as csvfile:
-                reader = csv.reader(csvfile)
-
-                # Read the headers and split them
-                headers = next(reader)
-                headers = [header.strip() for header in headers[0].split(';')]
-
-                # Iterate over the rows and create the mapping
-                for row in reader:
-                    row_dict = dict(zip(headers, row[0].split(';')))
-                    in_value = row_dict["IN_"]
-                    out_value = row_dict["OUT"]
-                    in_out_map[in_value] = out_value
-            
-            
-        except Exception as e:
-            feedback.pushInfo(f"An error occurred while creating the mapping: {e}")
-            
-        #------------------call shp ------------------
-        solo=soil
-        # Check if the layer is valid
-        if not solo.isValid():
-            feedback.pushInfo("Failed to load the layer!")
-            feedback.pushInfo("Error details:", solo.error().summary())
-            feedback.pushInfo("File readable:", os.access(caminho_soil, os.R_OK))
-        else:
-            #print("Carregou layer")
-            # Start editing the layer
-            solo.startEditing()
-
-            # Add a new field to store the "OUT" values
-            new_field = QgsField("OUT", QVariant.Double)
-            solo.dataProvider().addAttributes([new_field])
-            solo.updateFields()
-
-            # Get the index of the new field
-            out_field_index = solo.fields().indexFromName("OUT")
-
-            # Iterate over each feature in the layer
-            for feature in solo.getFeatures():
-                classifica_value = feature[coluna_recls]
-                # Check if the "CLASSIFICA" value exists in the mapping
-                if classifica_value in in_out_map:
-                    out_value = in_out_map[classifica_value]
-                    # Update the new field with the "OUT" value
-                    solo.dataProvider().changeAttributeValues({feature.id(): {out_field_index: out_value}})
-
-
-
-        #------------------shp to raster------------------
-
-
-        reclassifys=processing.run("gdal:rasterize", {'INPUT':f'{caminho_soil}','FIELD':'OUT','BURN':0,'USE_Z':False,'UNITS':1,'WIDTH':25,'HEIGHT':25,'EXTENT':extent,'NODATA':0,'OPTIONS':None,'DATA_TYPE':5,'INIT':None,'INVERT':False,'EXTRA':'','OUTPUT':f'{pasta}/s.tif'},is_child_algorithm = True,context=context,feedback=feedback)
-        if feedback.isCanceled():
-            return {}
-        
-        feedback.setProgress(50)
-        feedback.pushInfo('acabou S')
+        def estagio_s(feedback, context, resultados):
+            caminho, chaves = resultados['SOLO']
+            lut = class_lut(chaves, campos_solo.index(coluna_recls), load_reclass_table(caminho_recls_csv))
+            feedback.pushInfo('acabou S')
+            return RatingSource(partial(gdal.Open, caminho), rate_by_lookup(lut))
 
         #------------------------------------------------------T------------------------------------------------------
 
-        declive=processing.run("native:slope",\
-            {'INPUT':f'{caminho_topo}',\
-                'Z_FACTOR':1,\
-                'OUTPUT':f'{pasta}/slope.tif'
-            },
-            is_child_algorithm = True,
-            context=context,
-            feedback=feedback
-        )
-        if feedback.isCanceled():
-            return {}
-        
-        slope=QgsRasterLayer(declive['OUTPUT'],"slope")
-
-
-        # Criar a expressão para o raster calculator Aqui, estamos reclassificando os valores entre valor_inicial e valor_final para valor_reclassificado
-        expressaot = (
-            '("slope@1" >= 0 AND "slope@1" < 2) * 10 + '
-            '("slope@1" >= 2 AND "slope@1" < 6) * 9 + '
-            '("slope@1" >= 6 AND "slope@1" < 12) * 5 + '
-            '("slope@1" >= 12 AND "slope@1" < 18) * 3 + '
-            '("slope@1" >= 18 AND "slope@1" < 99999) * 1 + '
-            '("slope@1" < 0 OR "slope@1" >= 99999) * "slope@1"'
-        )
-        #Configurar as entradas para o raster calculator
-        #entradas = [QgsRasterCalculatorEntry(slope, 1, 'topo@1')]
-
-        qrce = QgsRasterCalculatorEntry()
-        qrce.bandNumber = 1
-        qrce.raster = slope
-        qrce.ref = 'slope@1'
-
-        entradas = [qrce]
-
-
-        #Criar o objeto QgsRasterCalculator
-        reclassifyt = QgsRasterCalculator(expressaot, f"{pasta}/t.tif", "GTiff", slope.extent(), slope.width(), slope.height(), entradas)
-
-        #Executar o cálculo
-        reclassifyt.processCalculation()
-        feedback.setProgress(63)
-        feedback.pushInfo('acabou T')
+        def estagio_t(feedback, context, resultados):
+            # Slope is computed and rated block by block inside the overlay, at
+            # about the DEM's own resolution and then averaged per output pixel;
+            # no slope.tif
+            feedback.pushInfo('acabou T')
+            refinamento = grelha.native_refinement(caminho_topo, SLOPE_REFINE_MAX)
+            if refinamento > 1:
+                feedback.pushInfo(f"Slope computed on {grelha.pixel / refinamento:g} map unit cells, close to the DEM resolution")
+            return SlopeRatingSource(
+                grelha.opener(caminho_topo, 'bilinear', refinamento), rate_by_breaks(T_BREAKS, T_RATINGS), refinamento
+            )
 
         #------------------------------------------------------I------------------------------------------------------
-        #------------------shp------------------
-        soil = QgsVectorLayer(f"{caminho_soil}", "Soil", "ogr")
-
-        #------------------shp add values------------------
-
-        #------------------call csv------------------
-
-        try:
-            # Open the CSV file
-            with open(caminho_recli_csv, newline='', encoding='utf-8-sig') as csvfile:
-                # Create a CSV reader object
-                reader = csv.reader(csvfile)
-                
-            # Read the headers and split them
-                headers = next(reader)
-                headers = [header.strip() for header in headers[0].split(';')]
-
-                for i, row in enumerate(reader):
-                    if i < 5:  # Print only the first 5 rows
-                        row_dict = dict(zip(headers, row[0].split(';')))
-                        #print(row_dict)
-                    else:
-                        break
-
-        except FileNotFoundError:
-            feedback.pushInfo(f"Error: The file at {csv_path} was not found.")
-        except Exception as e:
-            feedback.pushInfo(f"An error occurred: {e}")
-
-
-        in_out_map = {} #este dicionário é o csv transformado para visualizar faz print(in_out_map) antes de except
-        try:
-            # Open the CSV file again to create the mapping
-            with open(caminho_recli_csv, newline='', encoding='utf-8-sig') as csvfile:
-                reader = csv.reader(csvfile)
-
-                # Read the headers and split them
-                headers = next(reader)
-                headers = [header.strip() for header in headers[0].split(';')]
-
-                # Iterate over the rows and create the mapping
-                for row in reader:
-                    row_dict = dict(zip(headers, row[0].split(';')))
-                    in_value = row_dict["IN_"]
-                    out_value = row_dict["OUT"]
-                    in_out_map[in_value] = out_value
-
-            
-            
-        except Exception as e:
-            feedback.pushInfo(f"An error occurred while creating the mapping: {e}")
-
-
-        #------------------call shp ------------------
-        solo=soil
-        # Check if the layer is valid
-        if not solo.isValid():
-            feedback.pushInfo("Failed to load the layer!")
-            feedback.pushInfo("Error details:", solo.error().summary())
-            feedback.pushInfo("File readable:", os.access(caminho_soil, os.R_OK))
-        else:
-            # Start editing the layer
-            solo.startEditing()
 
-            # Add a new field to store the "OUT" values
-            new_field = QgsField("OUT", QVariant.Double)
-            solo.dataProvider().addAttributes([new_field])
-            solo.updateFields()
-
-            # Get the index of the new field
-            out_field_index = solo.fields().indexFromName("OUT")
-
-            # Iterate over each feature in the layer
-            for feature in solo.getFeatures():
-                classifica_value = feature[coluna_recli]
-                # Check if the "CLASSIFICA" value exists in the mapping
-                if classifica_value in in_out_map:
-                    out_value = in_out_map[classifica_value]
-                    # Update the new field with the "OUT" value
-                    solo.dataProvider().changeAttributeValues({feature.id(): {out_field_index: out_value}})
-            solo.commitChanges()
-
-
-
-        #------------------shp to raster------------------
-
-        reclassifys=processing.run("gdal:rasterize", {'INPUT':f'{caminho_soil}','FIELD':'OUT','BURN':0,'USE_Z':False,'UNITS':1,'WIDTH':25,'HEIGHT':25,'EXTENT':extent,'NODATA':0,'OPTIONS':None,'DATA_TYPE':5,'INIT':None,'INVERT':False,'EXTRA':'','OUTPUT':f'{pasta}/i.tif'},is_child_algorithm = True,context=context,feedback=feedback)
-        if feedback.isCanceled():
-            return {}
-        
-        feedback.setProgress(75)
-        feedback.pushInfo('acabou I')
+        def estagio_i(feedback, context, resultados):
+            caminho, chaves = resultados['SOLO']
+            lut = class_lut(chaves, campos_solo.index(coluna_recli), load_reclass_table(caminho_recli_csv))
+            feedback.pushInfo('acabou I')
+            return RatingSource(partial(gdal.Open, caminho), rate_by_lookup(lut))
 
         #------------------------------------------------------C------------------------------------------------------
-        feedback.setProgress(88)
-        feedback.pushInfo("acabou C")
-
-        #------------------------------------------------------Soma------------------------------------------------------
-
-
-        # ------------------ D ------------------
-
-        d = QgsRasterLayer(f"{pasta}/d.tif", "d")
-
-        if not d.isValid():
-
-            raise Exception("Layer d.tif not valid")
-
-        dqrce = QgsRasterCalculatorEntry()
-
-        dqrce.bandNumber = 1
-
-        dqrce.raster = d
-
-        dqrce.ref = 'd@1'
-
-         
-
-        # ------------------ R ------------------
-
-        r = QgsRasterLayer(f"{pasta}/r.tif", "r")
-
-        if not r.isValid():
-
-            raise Exception("Layer r.tif not valid")
-
-        rqrce = QgsRasterCalculatorEntry()
-
-        rqrce.bandNumber = 1
-
-        rqrce.raster = r
-
-        rqrce.ref = 'r@1'
-
-         
-
-        # ------------------ A ------------------
-
-        a = QgsRasterLayer(f"{pasta}/a.tif", "a")
-
-        if not a.isValid():
-
-            raise Exception("Layer a.tif not valid")
-
-        aqrce = QgsRasterCalculatorEntry()
-
-        aqrce.bandNumber = 1
-
-        aqrce.raster = a
-
-        aqrce.ref = 'a@1'
-
-         
-
-        # ------------------ S ------------------
-
-        s = QgsRasterLayer(f"{pasta}/s.tif", "s")
-
-        if not s.isValid():
-
-            raise Exception("Layer s.tif not valid")
 
-        sqrce = QgsRasterCalculatorEntry()
-
-        sqrce.bandNumber = 1
-
-        sqrce.raster = s
-
-        sqrce.ref = 's@1'
-
-         
-
-        # ------------------ T ------------------
-
-        t = QgsRasterLayer(f"{pasta}/t.tif", "t")
-
-        if not t.isValid():
-
-            raise Exception("Layer t.tif not valid")
-
-        tqrce = QgsRasterCalculatorEntry()
-
-        tqrce.bandNumber = 1
-
-        tqrce.raster = t
-
-        tqrce.ref = 't@1'
-
-         
-
-        # ------------------ I ------------------
-
-        i = QgsRasterLayer(f"{pasta}/i.tif", "i")
-
-        if not i.isValid():
-
-            raise Exception("Layer i.tif not valid")
-
-        iqrce = QgsRasterCalculatorEntry()
-
-        iqrce.bandNumber = 1
-
-        iqrce.raster = i
-
-        iqrce.ref = 'i@1'
-
-
-
-        # ------------------ Calculator Setup ------------------
-
-        entries = [dqrce, rqrce, aqrce, sqrce, tqrce, iqrce]
-
-         
-
-        expression = 'd@1*5 + r@1*4 + a@1*3 + s@1*2 + t@1*1 + i@1*5 + 1'
-
-         
-
-        calc = QgsRasterCalculator( expression, f"{pasta}/drastic.tif", 'GTiff', extent, d.width(), d.height(), entries)
-
-
-
-        result = calc.processCalculation()
-
-        if result != 0:
+        #------------------cache------------------
+
+        # A factor is reused from the cache when everything its ratings depend on
+        # is unchanged: source files, columns, CSV contents, grid and breakpoints.
+        cache = StageCache(os.path.join(pasta, 'drastic_cache'), cache_mb * 1024 * 1024) if cache_mb else None
+        chaves_cache = {}
+        em_cache = {}
+        if cache is not None:
+            identidades = {
+                'D': file_identity(caminho_points, points.providerType()),
+                'R': file_identity(caminho_prec, prec.providerType()),
+                'A': file_identity(caminho_geologia, geologia.providerType()),
+                'S': file_identity(caminho_soil, soil.providerType()),
+                'T': file_identity(caminho_topo, topo.providerType()),
+            }
+            identidades['I'] = identidades['S']
+            entradas_cache = {
+                'D': (
+                    identidades['D'], coluna_points, idw_motor, idw_potencia, idw_vizinhos, idw_raio,
+                    agregacao_pocos, coluna_poco, coluna_data, janela_datas, distancia_pocos, margem_pocos,
+                    validacao and (potencias_cv, vizinhos_cv),
+                    D_BREAKS, D_RATINGS,
+                ),
+                'R': (identidades['R'], R_BREAKS, R_RATINGS),
+                'A': (identidades['A'], coluna_recla, load_reclass_table(caminho_recla_csv).digest),
+                'S': (identidades['S'], coluna_recls, load_reclass_table(caminho_recls_csv).digest),
+                'T': (identidades['T'], T_BREAKS, T_RATINGS),
+                'I': (identidades['I'], coluna_recli, load_reclass_table(caminho_recli_csv).digest),
+            }
+            for f, entradas in entradas_cache.items():
+                if identidades[f] is None:
+                    feedback.pushInfo(f"{f} is not cached: no file backs its input layer")
+                    continue
+                chaves_cache[f] = cache.key(f, grelha.key(), entradas)
+                caminho = cache.get(chaves_cache[f])
+                if caminho is not None:
+                    em_cache[f] = caminho
+            feedback.pushInfo(f"Cache hits: {', '.join(em_cache) or 'none'}")
+
+        def estagio_em_cache(caminho):
+            return lambda feedback, context, resultados: RatingSource(partial(gdal.Open, caminho))
+
+        # Every factor only depends on its own inputs, except S and I which
+        # share the soil class raster.
+        estagios_factores = {
+            'D': estagio_d_de(fonte_pontos, caminho_points, index),
+            'R': estagio_r_de(caminho_prec),
+            'A': estagio_a,
+            'S': estagio_s,
+            'T': estagio_t,
+            'I': estagio_i,
+        }
+        estagios = []
+        if not {'S', 'I'} <= em_cache.keys():
+            estagios.append(Stage('SOLO', estagio_solo))
+        if zonas is not None:
+            estagios.append(Stage('ZONAS', estagio_zonas))
+        # Only D and R change between epochs. An epoch whose layer is the one
+        # of the single run reuses its factor, and epochs sharing a layer share
+        # one stage; etapas_epocas names the stage of each epoch's D and R.
+        etapas_epocas = []
+        por_fonte = {('R', caminho_prec): None, ('D', caminho_points): None}
+        for k, (chuva, pocos) in enumerate(zip(chuvas_epocas, pocos_epocas), start=1):
+            if ('R', chuva.source()) not in por_fonte:
+                por_fonte['R', chuva.source()] = f'R {k}'
+                estagios.append(Stage(f'R {k}', estagio_r_de(chuva.source())))
+            if ('D', pocos.source()) not in por_fonte:
+                if pocos.fields().indexOf(coluna_points) < 0:
+                    raise QgsProcessingException(f"The wells of epoch {k} ({pocos.name()}) have no {coluna_points} field")
+                por_fonte['D', pocos.source()] = f'D {k}'
+                estagios.append(Stage(f'D {k}', estagio_d_de(
+                    pocos,
+                    pocos.source(),
+                    pocos.fields().indexOf(coluna_points),
+                    f'D {k}',
+                    os.path.join(pasta, f'idw_cross_validation_{k}.csv'),
+                    f'idw_{k}.tif',
+                )))
+            etapas_epocas.append({'D': por_fonte['D', pocos.source()], 'R': por_fonte['R', chuva.source()]})
+        for f in FACTORS:
+            if f in em_cache:
+                estagios.append(Stage(f, estagio_em_cache(em_cache[f])))
+            else:
+                estagios.append(Stage(f, estagios_factores[f], depends=('SOLO',) if f in ('S', 'I') else ()))
+        multi_feedback = QgsProcessingMultiStepFeedback(2, feedback)
+        try:
+            fontes = run_stages(estagios, multi_feedback, context, max_workers=n_threads, report=relatorio)
+            if feedback.isCanceled():
+                return {}
+
+            feedback.pushInfo("acabou C")
+
+            #------------------------------------------------------Soma------------------------------------------------------
+
+            # One pass over aligned blocks of every factor; only the index is written
+            # unless the intermediates are kept, in which case every factor's ratings
+            # are written alongside.
+            output_path = self.parameterAsOutputLayer(parameters, 'drastic', context)
+            factor_paths = {f: [f'{pasta}/{f.lower()}.tif'] for f in FACTORS} if manter_intermedios else {}
+            for f, chave in chaves_cache.items():
+                if f not in em_cache:
+                    factor_paths.setdefault(f, []).append(cache.pending_path(chave))
+
+            # Bounds the index so it is written in the smallest exact type
+            nota_maxima = max(
+                *D_RATINGS, *R_RATINGS, *T_RATINGS,
+                *(load_reclass_table(csv_path).max_rating for csv_path in (caminho_recla_csv, caminho_recls_csv, caminho_recli_csv)),
+            )
 
-            raise Exception(f"Raster calculation failed with code: {result}")
+            # The class map is optional, the histogram and class areas always come out
+            classificacao = ClassOutput(limites_classes, nomes_classes, saida_classes, formato)
+            saidas = [classificacao]
+            if saida_cenarios:
+                saidas.append(ScenarioOutput(saida_cenarios, cenarios, formato, nota_maxima))
+            analise = SensitivityOutput(pesos, saida_pesos_efetivos, formato) if sensibilidade else None
+            if analise is not None:
+                saidas.append(analise)
+            if saida_pilha:
+                saidas.append(FactorStackOutput(saida_pilha, pesos, constante_c))
+            epocas = None
+            if n_epocas:
+                epocas = EpochOutput(
+                    saida_epocas,
+                    [
+                        (nome, {f: fontes[etapa] if etapa else None for f, etapa in etapas.items()})
+                        for nome, etapas in zip(nomes_epocas, etapas_epocas)
+                    ],
+                    pesos,
+                    constante_c,
+                    saida_mudanca,
+                    formato,
+                    nota_maxima,
+                )
+                saidas.append(epocas)
+            estatisticas = None
+            if zonas is not None:
+                caminho_zonas, entidades_zonas = fontes['ZONAS']
+                estatisticas = ZonalOutput(partial(gdal.Open, caminho_zonas), len(entidades_zonas), limites_classes)
+                saidas.append(estatisticas)
+
+            multi_feedback.setCurrentStep(1)
+            with relatorio.measure('overlay', process_cpu=True, pixels=grelha.cols * grelha.rows):
+                weighted_overlay(
+                    {f: fontes[f] for f in FACTORS},
+                    output_path,
+                    weights=pesos,
+                    constant=constante_c,
+                    factor_paths=factor_paths,
+                    outputs=saidas,
+                    tile_size=tamanho_tile,
+                    max_workers=n_threads,
+                    feedback=multi_feedback,
+                    raster_format=formato,
+                    max_rating=nota_maxima,
+                    report=relatorio,
+                )
+            if feedback.isCanceled():
+                return {}
+        finally:
+            # The in-memory intermediates go whatever way the run ends
+            if memoria is not None:
+                memoria.close()
+
+        saida_zonas = None
+        if estatisticas is not None:
+            campos = QgsFields(zonas.fields())
+            for nome in ('drastic_pixels', 'drastic_mean', 'drastic_min', 'drastic_max'):
+                campos.append(QgsField(nome, QVariant.Int if nome == 'drastic_pixels' else QVariant.Double))
+            for classe in classificacao.names:
+                campos.append(QgsField(f"area_{classe.replace(' ', '_')}", QVariant.Double))
+            (sink, saida_zonas) = self.parameterAsSink(
+                parameters, 'estatisticas_zonas', context, campos, zonas.wkbType(), zonas.sourceCrs()
+            )
+            if sink is not None:
+                for entidade, linha in zip(entidades_zonas, estatisticas.rows()):
+                    saida = QgsFeature(campos)
+                    saida.setGeometry(entidade.geometry())
+                    saida.setAttributes(entidade.attributes() + list(linha))
+                    sink.addFeature(saida, QgsFeatureSink.FastInsert)
+
+        tabelas_classes = classificacao.save(pasta)
+        feedback.pushInfo("Vulnerability classes:")
+        for linha in classificacao.class_areas()[1:]:
+            feedback.pushInfo("  {1}: {4} pixels, area {5:.0f}, {6:.1f} %".format(*linha))
+
+        tabela_epocas = None
+        if epocas is not None:
+            tabela_epocas = epocas.save(pasta)
+            feedback.pushInfo("Epochs:")
+            for nome, pixels, media, minimo, maximo in epocas.rows()[1:]:
+                if pixels:
+                    feedback.pushInfo(f"  {nome}: mean {media:.2f}, min {minimo:g}, max {maximo:g} over {pixels} pixels")
+                else:
+                    feedback.pushInfo(f"  {nome}: no valid pixel")
+
+        tabelas_sensibilidade = {}
+        if analise is not None:
+            tabelas_sensibilidade = analise.save(pasta)
+            for nome, linhas in analise.rows().items():
+                feedback.pushInfo(f"Sensitivity ({nome.replace('_', ' ')}):")
+                for linha in linhas[1:]:
+                    feedback.pushInfo("  {}: mean {:.2f}, min {:.2f}, max {:.2f}, std {:.2f}".format(*linha[:5]))
+
+        if cache is not None:
+            for f, chave in chaves_cache.items():
+                if f not in em_cache:
+                    cache.store(chave)
+            cache.evict()
+
+        # Where the time went, next to the outputs and in the log
+        caminho_relatorio = relatorio.save(
+            os.path.join(pasta, 'run_report.json'),
+            grid={'cols': grelha.cols, 'rows': grelha.rows, 'pixel': grelha.pixel, 'crs': grelha.crs},
+            cache_hits=sorted(em_cache),
+        )
+        feedback.pushInfo("Run report:")
+        for linha in relatorio.summary():
+            feedback.pushInfo(f"  {linha}")
 
-        
-        output_path = self.parameterAsOutputLayer(parameters, 'drastic', context)
-        shutil.copyfile(f"{pasta}/drastic.tif", output_path)
-        final_layer = QgsRasterLayer(output_path, "DRASTIC")
-        QgsProject.instance().addMapLayer(final_layer)
-        
+        # The 'drastic' destination is loaded by Processing when the algorithm
+        # runs from the toolbox; nothing here assumes an interactive project, so
+        # DRASTIC_batch.py can run it headless.
 
         return{
             "pasta": pasta,
-            "drastic":output_path}
+            "drastic":output_path,
+            "drastic_cenarios": saida_cenarios,
+            "pesos_efetivos": saida_pesos_efetivos,
+            "classes_drastic": saida_classes,
+            "pilha_factores": saida_pilha,
+            "drastic_epocas": saida_epocas,
+            "mudanca_epocas": epocas.change_path if epocas is not None else None,
+            "drastic_epochs_table": tabela_epocas,
+            **{f"drastic_{nome}": caminho for nome, caminho in tabelas_classes.items()},
+            **{f"sensitivity_{nome}": caminho for nome, caminho in tabelas_sensibilidade.items()},
+            "cache_hits": sorted(em_cache),
+            "relatorio": caminho_relatorio,
+            "estatisticas_zonas": saida_zonas,
+            "idw_cross_validation": caminho_validacao if validacao else None}
 
     def createInstance(self):
         return self.__class__()
@@ -0,0 +1,41 @@
+"""Smoke tests of the stage scheduler; they need a QGIS Python environment."""
+import os
+import sys
+
+import pytest
+
+pytest.importorskip("numpy")
+pytest.importorskip("osgeo.gdal")
+pytest.importorskip("qgis.core")
+
+from qgis.core import QgsProcessingContext, QgsProcessingFeedback  # noqa: E402
+from qgis.testing import start_app  # noqa: E402
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from DRASTIC_v3_en import RunReport, Stage, run_stages  # noqa: E402
+
+start_app()
+
+
+def _stages():
+    return [
+        Stage("A", lambda feedback, context, results: 1),
+        Stage("B", lambda feedback, context, results: results["A"] + 1, depends=("A",)),
+    ]
+
+
+@pytest.mark.parametrize("report", [None, RunReport()])
+def test_run_stages_honours_dependencies(report):
+    results = run_stages(_stages(), QgsProcessingFeedback(), QgsProcessingContext(), max_workers=2, report=report)
+    assert results == {"A": 1, "B": 2}
+    if report is not None:
+        assert sorted(step["name"] for step in report.steps) == ["A", "B"]
+
+
+def test_run_stages_raises_the_stage_error():
+    def fail(feedback, context, results):
+        raise ValueError("boom")
+
+    with pytest.raises(ValueError, match="boom"):
+        run_stages([Stage("A", fail)], QgsProcessingFeedback(), QgsProcessingContext())